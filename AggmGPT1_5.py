@@ -1,12 +1,118 @@
+import hashlib
 import math
+import os
 import random
 import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from data import corpus
+from memory import memory_report
+from metrics import NULL_METRICS
+from ngram import NgramCounts, NgramModel, Vocabulary
+from snapshot import (MappedNgramModel, SnapshotError, append_delta, corpus_digest, read_snapshot, training_digest,
+                      write_snapshot)
+from training import (CHUNK_SIZE, END_OF_TEXT, TokenStream, appended_chunks, count_shard, document_chunks,
+                      file_chunks, hashed_chunks, merge_shards, split_documents)
+
+ATTENTION_MODES = ('off', 'full', 'incremental')
+
+
+def make_rng(seed):
+    # A seed is None, anything random.Random accepts as a seed, or a
+    # random.Random to draw from.  None, or the random module itself, keeps
+    # using the shared random module.
+    if seed is None or seed is random:
+        return random
+    if isinstance(seed, random.Random):
+        return seed
+    return random.Random(seed)
+
+
+def copy_rng(rng):
+    # SystemRandom has no state to copy, and nothing drawn from it can be
+    # reproduced anyway, so it is shared instead.
+    if isinstance(rng, random.SystemRandom):
+        return rng
+    copy = random.Random()
+    copy.setstate(rng.getstate())
+    return copy
+
+
+class GenerationState:
+    # The last context_size token ids feed the n-gram lookup; tokens keeps the
+    # whole sequence for the attention pipeline and output the generated words.
+    # Each state samples from its own rng, and draws attention embeddings
+    # from a separate one.
+    def __init__(self, tokens, ids, context_size, rng=random, embedding_rng=None):
+        self.tokens = tokens
+        self.context = deque(ids, maxlen=context_size)
+        self.length = len(ids)
+        self.output = []
+        self.attention_cache = None
+        self.rng = rng
+        self.embedding_rng = embedding_rng
+
+    def push(self, token, token_id):
+        self.tokens.append(token)
+        self.context.append(token_id)
+        self.length += 1
+        self.output.append(token)
+
+
+class Session:
+    # A lightweight per-request handle on a shared model.  It owns its random
+    # stream, so sessions on different threads never share generator state;
+    # without a seed it starts from a fresh, OS-seeded one.
+    def __init__(self, model, seed=None):
+        self.model = model
+        self.rng = random.Random() if seed is None else make_rng(seed)
+
+    def ask(self, input_text):
+        return self.model.AskAggmGPT1_5(input_text, self.rng)
+
+    def stream(self, input_text):
+        return self.model.stream(input_text, self.rng)
+
+
+class AttentionCache:
+    # Encoded rows of every position seen so far.  Q, K and V are all the
+    # encoded embeddings, so the same rows serve as keys and values.
+    def __init__(self):
+        self.rows = []
+        self.buffer = None
+        self.length = 0
+
+    def extend(self, rows):
+        if np is not None and isinstance(rows, np.ndarray):
+            needed = self.length + len(rows)
+            if self.buffer is None or needed > len(self.buffer):
+                grown = np.empty((max(needed, 2 * self.length, 16), rows.shape[1]))
+                if self.buffer is not None:
+                    grown[:self.length] = self.buffer[:self.length]
+                self.buffer = grown
+            self.buffer[self.length:needed] = rows
+            self.length = needed
+            return self.buffer[:needed]
+        self.rows.extend(rows)
+        self.length = len(self.rows)
+        return self.rows
+
+
+QUESTION_WORDS = ['how', 'why', 'when', 'where', 'what', 'who', 'which', 'whose', 'whom', 'is', 'are',
+                  'do', 'does', 'did', 'can', 'could', 'will', 'would', 'should', 'may', 'might', "what's", ]
+
 
 def correct_text(text):
-    question_words = ['how', 'why', 'when', 'where', 'what', 'who', 'which', 'whose', 'whom', 'is', 'are', 
-                      'do', 'does', 'did', 'can', 'could', 'will', 'would', 'should', 'may', 'might', "what's", ]
+    question_words = QUESTION_WORDS
     
     text = ' '.join(text.split())
     
@@ -29,8 +135,157 @@ def correct_text(text):
     
     return text
 
+
+class StreamingReplace:
+    # str.replace(old, '') over text that arrives in pieces: anything that
+    # could still be the start of an occurrence is held back.
+    def __init__(self, old):
+        self.old = old
+        self.pending = ''
+
+    def feed(self, text):
+        buffer = self.pending + text
+        pieces = []
+        start = 0
+        while True:
+            found = buffer.find(self.old, start)
+            if found < 0:
+                break
+            pieces.append(buffer[start:found])
+            start = found + len(self.old)
+        keep = max(start, len(buffer) - len(self.old) + 1)
+        pieces.append(buffer[start:keep])
+        self.pending = buffer[keep:]
+        return ''.join(pieces)
+
+    def finish(self):
+        pending, self.pending = self.pending, ''
+        return pending
+
+
+class StreamingCorrector:
+    # remove_duplicates followed by correct_text, emitting only the prefix of
+    # the final text that no later word can change: the last word may still
+    # lose its punctuation, and the first separator becomes ', ' only once a
+    # question word is known to be in the text.
+    def __init__(self):
+        self.partial = ''
+        self.words = []
+        self.seen = set()
+        self.emitted = ''
+        self.checked = 0
+        self.done = 0
+        self.question = False
+
+    def feed(self, text):
+        if not text:
+            return ''
+        pieces = (self.partial + text).split()
+        if not text[-1].isspace():
+            self.partial = pieces.pop() if pieces else ''
+        else:
+            self.partial = ''
+        for word in pieces:
+            if word not in self.seen:
+                self.seen.add(word)
+                self.words.append(word)
+        return self._emit(len(self.words) - 1)
+
+    def _emit(self, stable):
+        # words[:stable] are final; the last word may still lose its punctuation
+        for i in range(self.checked, stable):
+            word = self.words[i]
+            if i == 0:
+                word = word[0].upper() + word[1:]
+            self.question = self.question or word.lower() in QUESTION_WORDS
+        self.checked = max(self.checked, stable)
+        chunks = []
+        if not self.done and stable >= 1:
+            chunks.append(self.words[0][0].upper() + self.words[0][1:])
+            self.done = 1
+        if self.question:
+            for i in range(self.done, stable):
+                chunks.append((', ' if i == 1 else ' ') + self.words[i])
+            self.done = max(self.done, stable)
+        chunk = ''.join(chunks)
+        self.emitted += chunk
+        return chunk
+
+    def finish(self):
+        if self.partial and self.partial not in self.seen:
+            self.words.append(self.partial)
+        self.partial = ''
+        text = correct_text(' '.join(self.words))
+        return text[len(self.emitted):]
+
+
+class PositionalEncodingCache:
+    # Encoding rows are the same for every call with the same d_model, so they
+    # are computed once, up to max_length positions, and later calls slice.
+    def __init__(self, max_length=4096):
+        self.max_length = max_length
+        self.lock = threading.Lock()
+        self.denominators = {}
+        self.tables = {}
+        self.arrays = {}
+
+    def _denominators(self, d_model):
+        if d_model not in self.denominators:
+            self.denominators[d_model] = [10000 ** (i / d_model) for i in range(d_model)]
+        return self.denominators[d_model]
+
+    def _row(self, pos, denominators):
+        return tuple(math.sin(pos / d) if i % 2 == 0 else math.cos(pos / d) for i, d in enumerate(denominators))
+
+    def rows(self, seq_len, d_model):
+        table = self.tables.get(d_model)
+        if table is None or len(table) < min(seq_len, self.max_length):
+            with self.lock:
+                denominators = self._denominators(d_model)
+                table = self.tables.setdefault(d_model, [])
+                table.extend(self._row(pos, denominators) for pos in range(len(table), min(seq_len, self.max_length)))
+        if seq_len <= len(table):
+            return table[:seq_len]
+        denominators = self._denominators(d_model)
+        return table + [self._row(pos, denominators) for pos in range(len(table), seq_len)]
+
+    def array(self, seq_len, d_model):
+        table = self.arrays.get(d_model)
+        if table is None or len(table) < min(seq_len, self.max_length):
+            with self.lock:
+                # grow by doubling so a generation growing one token at a time
+                # rebuilds the table only a logarithmic number of times
+                length = min(max(seq_len, 2 * (0 if table is None else len(table)), 64), self.max_length)
+                table = self._array(0, length, d_model)
+                table.setflags(write=False)
+                self.arrays[d_model] = table
+        if seq_len <= len(table):
+            return table[:seq_len]
+        return np.concatenate((table, self._array(len(table), seq_len, d_model)))
+
+    def _array(self, start, stop, d_model):
+        i = np.arange(d_model)
+        angles = np.arange(start, stop, dtype=float)[:, None] / np.array(self._denominators(d_model))
+        return np.where(i % 2 == 0, np.sin(angles), np.cos(angles))
+
+
 class AggmGPT1_5:
-    def __init__(self, model_name='AggmGPT-1.5', max_length=1000):
+    # After construction only the locked attention_stats, metrics and cache
+    # change, and add_documents, which publishes its updates atomically, so
+    # one instance can serve many threads at once.  Everything a single
+    # generation mutates lives in its GenerationState.
+    positional_encodings = PositionalEncodingCache()
+
+    def __init__(self, model_name='AggmGPT-1.5', max_length=1000, snapshot=None, ngram_models=None,
+                 attention='off', backend='auto', metrics=None, cache=None, pruning=None):
+        if attention not in ATTENTION_MODES:
+            raise ValueError(f'attention must be one of {ATTENTION_MODES}, got {attention!r}')
+        if backend == 'auto':
+            backend = 'python' if np is None else 'numpy'
+        if backend not in ('python', 'numpy'):
+            raise ValueError(f"backend must be 'auto', 'python' or 'numpy', got {backend!r}")
+        if backend == 'numpy' and np is None:
+            raise ImportError("backend='numpy' requires NumPy to be installed")
         self.ModelName = model_name
         self.max_length = max_length
         self.user = 'user'
@@ -41,28 +296,113 @@ class AggmGPT1_5:
         self.GREEN = '\033[92m'
         self.BLUE = '\033[94m'
         self.RESET = '\033[0m'
-        self.ngram_models = self.train_model(corpus)
+        # The attention output never affects the prediction, so generation
+        # skips it unless asked for; it draws from its own RNG so turning it
+        # on or off does not change the sampled words.
+        self.attention = attention
+        self.backend = backend
+        self.attention_stats = {'calls': 0, 'seconds': 0.0}
+        self.stats_lock = threading.Lock()
+        self.update_lock = threading.Lock()
+        self.embedding_random = random.Random()
+        self.metrics = NULL_METRICS if metrics is None else metrics
+        self.cache = cache
+        self.pruning = pruning
+        if ngram_models is None and snapshot is not None and os.path.exists(snapshot):
+            try:
+                ngram_models = self.read_snapshot(snapshot, corpus, self.training_settings())
+            except SnapshotError as e:
+                print(f'{self.RED}\nIgnoring snapshot {snapshot}: {e}{self.RESET}')
+        self.ngram_models = ngram_models
+        if ngram_models is None:
+            self.ngram_models = self.train_model(corpus)
+            if snapshot is not None:
+                self.save(snapshot)
+
+    def session(self, seed=None):
+        return Session(self, seed)
+
+    @classmethod
+    def load(cls, path, model_name='AggmGPT-1.5', max_length=1000, training_corpus=corpus, mapped=False,
+             **options):
+        pruning = options.get('pruning')
+        settings = '' if pruning is None else pruning.settings()
+        if mapped:
+            ngram_models = MappedNgramModel(path, training_corpus, settings)
+        else:
+            ngram_models = cls.read_snapshot(path, training_corpus, settings)
+        return cls(model_name, max_length, ngram_models=ngram_models, **options)
+
+    def save(self, path, training_corpus=None):
+        # Works for mapped models too; deltas they loaded or added are folded
+        # in.  The snapshot records the text the model was trained on, or
+        # training_corpus if given; a model that does not know needs it.
+        with self.update_lock:
+            write_snapshot(path, self.ngram_models, training_corpus, self.training_settings())
+
+    @staticmethod
+    def read_snapshot(path, training_corpus=corpus, settings=''):
+        return read_snapshot(path, training_corpus, settings)
+
+    def training_settings(self):
+        # recorded in snapshots, so one trained with other settings is stale
+        return '' if self.pruning is None else self.pruning.settings()
+
+    def memory_report(self, top=10):
+        return memory_report(self.ngram_models, top)
 
     def mat_mul(self, A, B):
+        if self.backend == 'numpy':
+            return np.matmul(np.asarray(A, dtype=float), np.asarray(B, dtype=float))
         result = []
         for i in range(len(A)):
             result.append([sum(A[i][k] * B[k][j] for k in range(len(B))) for j in range(len(B[0]))])
         return result
 
     def softmax(self, x):
-        exp_x = [math.exp(v - max(x)) for v in x]
+        if self.backend == 'numpy':
+            x = np.asarray(x, dtype=float)
+            if x.size == 0:
+                return x
+            exp_x = np.exp(x - x.max(axis=-1, keepdims=True))
+            return exp_x / exp_x.sum(axis=-1, keepdims=True)
+        if not x:
+            return []
+        max_x = max(x)
+        exp_x = [math.exp(v - max_x) for v in x]
         sum_exp_x = sum(exp_x)
         return [e / sum_exp_x for e in exp_x]
 
+    def softmax_rows(self, scores):
+        if self.backend == 'numpy':
+            return self.softmax(scores)
+        exp = math.exp
+        weights = []
+        for row in scores:
+            max_row = max(row) if row else 0
+            exp_row = [exp(v - max_row) for v in row]
+            sum_exp_row = sum(exp_row)
+            weights.append([e / sum_exp_row for e in exp_row])
+        return weights
+
     def self_attention(self, Q, K, V):
+        if self.backend == 'numpy':
+            Q, K, V = (np.asarray(M, dtype=float) for M in (Q, K, V))
+            return np.matmul(self.softmax(np.matmul(Q, np.swapaxes(K, -1, -2))), V)
         scores = [[sum(Q[i][idx] * K[j][idx] for idx in range(len(Q[i]))) for j in range(len(K))] for i in range(len(Q))]
-        attention_weights = [self.softmax(row) for row in scores]
+        attention_weights = self.softmax_rows(scores)
         output = [[sum(attention_weights[i][k] * V[k][j] for k in range(len(V))) for j in range(len(V[0]))] for i in range(len(V))]
         return output
 
     def multi_head_attention(self, Q, K, V, num_heads):
         d_model = len(Q[0])
         head_size = d_model // num_heads
+        if self.backend == 'numpy':
+            # (seq, heads * head_size) -> (heads, seq, head_size), attended as one batch and
+            # stacked head after head like the list version
+            heads = [np.asarray(M, dtype=float)[:, :num_heads * head_size]
+                     .reshape(len(M), num_heads, head_size).swapaxes(0, 1) for M in (Q, K, V)]
+            return self.self_attention(*heads).reshape(num_heads * len(Q), head_size)
         outputs = []
         for head in range(num_heads):
             q_head = [row[head * head_size:(head + 1) * head_size] for row in Q]
@@ -73,16 +413,23 @@ class AggmGPT1_5:
         return outputs
 
     def positional_encoding(self, seq_len, d_model):
-        encoding = [[math.sin(pos / (10000 ** (i / d_model))) if i % 2 == 0 else math.cos(pos / (10000 ** (i / d_model))) for i in range(d_model)] for pos in range(seq_len)]
-        return encoding
+        if self.backend == 'numpy':
+            return self.positional_encodings.array(seq_len, d_model)
+        return self.positional_encodings.rows(seq_len, d_model)
 
     def add_positional_encoding(self, embeddings, positional_encodings):
+        if self.backend == 'numpy':
+            embeddings = np.asarray(embeddings, dtype=float)
+            return embeddings + np.asarray(positional_encodings, dtype=float)[:len(embeddings), :embeddings.shape[1]]
         return [[val + positional_encodings[i][j] for j, val in enumerate(row)] for i, row in enumerate(embeddings)]
 
     def feed_forward_network(self, x):
         input_dim = len(x[0])
         hidden_dim = 10
         output_dim = 10
+        if self.backend == 'numpy':
+            hidden = np.maximum(0, np.matmul(np.asarray(x, dtype=float), np.eye(input_dim, hidden_dim)))
+            return np.matmul(hidden, np.ones((hidden_dim, output_dim)))
         W1 = [[1 if i == j else 0 for j in range(hidden_dim)] for i in range(input_dim)]
         b1 = [0] * hidden_dim
         W2 = [[1 for _ in range(output_dim)] for _ in range(hidden_dim)]
@@ -94,44 +441,158 @@ class AggmGPT1_5:
     def tokenize(self, text):
         return text.lower().split()
 
-    def embed_tokens(self, tokens):
-        return [[random.random() for _ in range(3)] for _ in tokens]
+    def embed_tokens(self, tokens, rng=None):
+        rng = self.embedding_random if rng is None else rng
+        return [[rng.random() for _ in range(3)] for _ in tokens]
+
+    def embedding_rng(self, rng):
+        # A seeded generation draws its embeddings from a copy of its own
+        # stream, so they are reproducible without moving the sampling stream.
+        if rng is random:
+            return self.embedding_random
+        return copy_rng(rng)
 
     def build_ngram_models(self, corpus, min_n=1, max_n=5):
-        ngram_models = {}
-        words = self.tokenize(corpus)
-        for n in range(min_n, max_n + 1):
-            model = {}
-            for i in range(len(words) - n):
-                context = ' '.join(words[i:i+n-1])
-                next_word = words[i+n-1]
-                if context not in model:
-                    model[context] = []
-                model[context].append(next_word)
-            ngram_models[f"{n}gram_model"] = model
-        return ngram_models
+        vocabulary = Vocabulary()
+        counts = NgramCounts(min_n, max_n)
+        ids = [vocabulary.add(word) for word in self.tokenize(corpus)]
+        counts.add(ids)
+        counts.carry = ids[-max_n:]
+        return self.model_from_counts(vocabulary, counts)
+
+    def model_from_counts(self, vocabulary, counts):
+        if self.pruning is not None:
+            counts = self.pruning.prune_counts(counts)
+        return NgramModel.from_counts(vocabulary, counts)
+
+    def predict_next_id(self, context, length, models, rng=random):
+        return self.sample_match(models.longest_match(context, self.maxNgram - 1), length, rng)
+
+    def sample_match(self, match, length, rng=random):
+        depth, successors = match
+        # the unigram table is only consulted when there is no context at all
+        if successors is None or depth < self.minNgram - 1 or (depth == 0 and length):
+            return None
+        return successors.sample(rng)
 
-    def predict_next_word(self, text, models):
-        words = self.tokenize(text)
-        for n in range(self.maxNgram, self.minNgram - 1, -1):
-            if len(words) >= n - 1:
-                context = ' '.join(words[-(n-1):])
-                model = models.get(f"{n}gram_model", {})
-                if context in model:
-                    return random.choice(model[context])
-        return ''
-
-    def predict_next_word_with_attention(self, text):
-        tokens = self.tokenize(text)
+    def predict_next_word(self, text, models, seed=None):
+        ids = models.vocabulary.encode(self.tokenize(text))
+        next_id = self.predict_next_id(ids, len(ids), models, make_rng(seed))
+        return '' if next_id is None else models.vocabulary.token(next_id)
+
+    def attention_pipeline(self, tokens, rng=None):
+        start = time.perf_counter()
         d_model = 3
-        embeddings = self.embed_tokens(tokens)
+        embeddings = self.embed_tokens(tokens, rng)
         positional_encodings = self.positional_encoding(len(tokens), d_model)
         encoded_embeddings = self.add_positional_encoding(embeddings, positional_encodings)
         num_heads = 1 if len(tokens) > 25 else max(1, len(tokens))
         attention_output = self.multi_head_attention(encoded_embeddings, encoded_embeddings, encoded_embeddings, num_heads)
         ff_output = self.feed_forward_network(attention_output)
-        ngram_prediction = self.predict_next_word(text, self.ngram_models)
-        return ngram_prediction
+        self.record_attention(time.perf_counter() - start)
+        return ff_output
+
+    def incremental_attention(self, state):
+        # Attention for the newest query row only, against cached keys and
+        # values, so a step costs O(sequence length) instead of O(length^2).
+        seq_len = len(state.tokens)
+        if not seq_len:
+            return None
+        start = time.perf_counter()
+        d_model = 3
+        if state.attention_cache is None:
+            state.attention_cache = AttentionCache()
+        cache = state.attention_cache
+        keys = cache.buffer[:cache.length] if cache.buffer is not None else cache.rows
+        if cache.length < seq_len:
+            embeddings = self.embed_tokens(state.tokens[cache.length:], state.embedding_rng)
+            positional_encodings = self.positional_encoding(seq_len, d_model)[cache.length:]
+            keys = cache.extend(self.add_positional_encoding(embeddings, positional_encodings))
+        num_heads = 1 if seq_len > 25 else max(1, seq_len)
+        head_size = d_model // num_heads
+        if self.backend == 'numpy':
+            heads = keys[:, :num_heads * head_size].reshape(seq_len, num_heads, head_size).swapaxes(0, 1)
+            attention_output = self.self_attention(heads[:, -1:], heads, heads).reshape(num_heads, head_size)
+        else:
+            attention_output = []
+            for head in range(num_heads):
+                k_head = [row[head * head_size:(head + 1) * head_size] for row in keys]
+                query = k_head[-1]
+                weights = self.softmax([sum(q * k for q, k in zip(query, row)) for row in k_head])
+                attention_output.append([sum(w * row[j] for w, row in zip(weights, k_head)) for j in range(head_size)])
+        ff_output = self.feed_forward_network(attention_output)
+        self.record_attention(time.perf_counter() - start)
+        return ff_output
+
+    def record_attention(self, seconds):
+        with self.stats_lock:
+            self.attention_stats['calls'] += 1
+            self.attention_stats['seconds'] += seconds
+
+    def predict_next_word_with_attention(self, text, seed=None):
+        rng = make_rng(seed)
+        self.attention_pipeline(self.tokenize(text), self.embedding_rng(rng))
+        return self.predict_next_word(text, self.ngram_models, rng)
+
+    def start_generation(self, text, seed=None):
+        rng = make_rng(seed)
+        if self.metrics.enabled:
+            with self.metrics.time('stage_seconds', stage='tokenize'):
+                tokens = self.tokenize(text)
+        else:
+            tokens = self.tokenize(text)
+        return GenerationState(tokens, self.ngram_models.vocabulary.encode(tokens), self.maxNgram - 1, rng,
+                               self.embedding_rng(rng) if self.attention != 'off' else None)
+
+    def attend(self, state):
+        if self.attention == 'full':
+            self.attention_pipeline(state.tokens, state.embedding_rng)
+        elif self.attention == 'incremental':
+            self.incremental_attention(state)
+
+    def generate_next_id(self, state):
+        metrics = self.metrics
+        if not metrics.enabled:
+            self.attend(state)
+            return self.predict_next_id(state.context, state.length, self.ngram_models, state.rng)
+        if self.attention != 'off':
+            with metrics.time('stage_seconds', stage='attention'):
+                self.attend(state)
+        start = time.perf_counter()
+        match = self.ngram_models.longest_match(state.context, self.maxNgram - 1)
+        next_id = self.sample_match(match, state.length, state.rng)
+        metrics.observe('stage_seconds', time.perf_counter() - start, stage='lookup')
+        if next_id is not None:
+            metrics.inc('backoff_order_total', order=str(match[0] + 1))
+        return next_id
+
+    def generate_next_ids(self, states, matches=None):
+        # One lookup per distinct context.  matches can be kept across steps:
+        # a batch deliberately keeps the match it found for a context for its
+        # whole run, even if add_documents changes the tables meanwhile, so
+        # every state in it sees the same answer.  Every state still samples
+        # from its own rng, in batch order, and metrics are recorded per
+        # state, as generate_next_id would.
+        models = self.ngram_models
+        metrics = self.metrics
+        matches = {} if matches is None else matches
+        next_ids = []
+        for state in states:
+            if self.attention != 'off':
+                with metrics.time('stage_seconds', stage='attention'):
+                    self.attend(state)
+            start = time.perf_counter() if metrics.enabled else 0.0
+            context = tuple(state.context)
+            match = matches.get(context)
+            if match is None:
+                match = matches[context] = models.longest_match(context, self.maxNgram - 1)
+            next_id = self.sample_match(match, state.length, state.rng)
+            if metrics.enabled:
+                metrics.observe('stage_seconds', time.perf_counter() - start, stage='lookup')
+                if next_id is not None:
+                    metrics.inc('backoff_order_total', order=str(match[0] + 1))
+            next_ids.append(next_id)
+        return next_ids
 
     def clean_user_input(self, text):
         return text.lower()
@@ -144,51 +605,251 @@ class AggmGPT1_5:
         print(f'{self.RED}\r[{bar}] {percent:.2f}% Complete{self.RESET}', end='')
 
     def train_model(self, corpus):
+        metrics = self.metrics
         print(f'{self.RED}\nTraining for {self.ModelName} has begun.{self.RESET}')
-        cleaned_corpus = re.sub(r'[\r\n]+', ' ', corpus.strip())
+        with metrics.time('training_phase_seconds', phase='join_lines'):
+            cleaned_corpus = re.sub(r'[\r\n]+', ' ', corpus.strip())
         self.print_progress(0, 3)
-        cleaned_corpus = re.sub(r'[.,!?]', '', cleaned_corpus)
+        with metrics.time('training_phase_seconds', phase='strip_punctuation'):
+            cleaned_corpus = re.sub(r'[.,!?]', '', cleaned_corpus)
         self.print_progress(1, 3)
-        ngram_models = self.build_ngram_models(cleaned_corpus)
+        with metrics.time('training_phase_seconds', phase='build_ngram_models'):
+            ngram_models = self.build_ngram_models(cleaned_corpus)
+        ngram_models.digest = corpus_digest(corpus, self.training_settings())
         self.print_progress(2, 3)
         self.print_progress(3, 3)
         print(f'{self.RED}\nTraining complete.{self.RESET}')
         return ngram_models
 
-    def predict_sentence_with_attention(self, input_text, output_length):
-        cleaned_input = self.clean_user_input(input_text)
-        sentence = cleaned_input
+    def train_files(self, paths, chunk_size=CHUNK_SIZE):
+        return self.train_chunks(file_chunks(paths, chunk_size))
+
+    def train_documents(self, documents, chunk_size=CHUNK_SIZE):
+        return self.train_chunks(document_chunks(documents, chunk_size))
+
+    def train_chunks(self, chunks):
+        # train_model for text that never has to be in memory all at once:
+        # only the counts and one chunk are held.
+        metrics = self.metrics
+        print(f'{self.RED}\nStreaming training for {self.ModelName} has begun.{self.RESET}')
+        text_hash = hashlib.sha256()
+        chunks = hashed_chunks(chunks, text_hash)
+        vocabulary = Vocabulary()
+        counts = NgramCounts(self.minNgram, self.maxNgram)
+        tokens = TokenStream()
+        add = vocabulary.add
+        with metrics.time('training_phase_seconds', phase='count_stream'):
+            for chunk in chunks:
+                counts.feed([add(word) for word in tokens.feed(chunk)])
+            counts.feed([add(word) for word in tokens.finish()])
+        with metrics.time('training_phase_seconds', phase='build_model'):
+            ngram_models = self.model_from_counts(vocabulary, counts)
+        ngram_models.digest = training_digest(text_hash, self.training_settings())
+        print(f'{self.RED}Training complete: {len(vocabulary)} words.{self.RESET}')
+        return ngram_models
+
+    def train_parallel(self, documents, workers=None, shards=None, chunk_size=CHUNK_SIZE):
+        # train_documents split into contiguous shards counted in worker
+        # processes; merging the partial tables in order gives exactly the
+        # single-process model.
+        metrics = self.metrics
+        documents = list(documents)
+        workers = workers or os.cpu_count()
+        ranges = split_documents(documents, shards or workers)
+        print(f'{self.RED}\nParallel training for {self.ModelName} has begun: '
+              f'{len(ranges)} shards on {workers} workers.{self.RESET}')
+        with metrics.time('training_phase_seconds', phase='count_shards'):
+            with ProcessPoolExecutor(workers) as pool:
+                results = pool.map(count_shard, ranges, [i == 0 for i in range(len(ranges))],
+                                   [i == len(ranges) - 1 for i in range(len(ranges))],
+                                   repeat(self.minNgram), repeat(self.maxNgram), repeat(chunk_size))
+                vocabulary, counts = merge_shards(results, self.minNgram, self.maxNgram)
+        with metrics.time('training_phase_seconds', phase='build_model'):
+            ngram_models = self.model_from_counts(vocabulary, counts)
+        # the text the shards were cut from, as train_documents hashes it
+        text_hash = hashlib.sha256()
+        for chunk in document_chunks(documents, chunk_size):
+            text_hash.update(chunk.encode('utf-8'))
+        ngram_models.digest = training_digest(text_hash, self.training_settings())
+        print(f'{self.RED}Training complete: {len(vocabulary)} words.{self.RESET}')
+        return ngram_models
+
+    def add_documents(self, documents, snapshot=None, chunk_size=CHUNK_SIZE):
+        # Online training: the same tables as retraining on the corpus with
+        # the documents appended, each followed by <|endoftext|>, but only
+        # the contexts the new text touches are recounted.  Generations that
+        # are running see each update all at once.  With snapshot, the
+        # update is also appended to that file, which must hold this model.
+        models = self.ngram_models
+        vocabulary = models.vocabulary
+        with self.update_lock:
+            with self.metrics.time('training_phase_seconds', phase='add_documents'):
+                first_new = len(vocabulary)
+                counts = NgramCounts(self.minNgram, self.maxNgram)
+                counts.carry = list(models.tail)
+                tokens = TokenStream()
+                add = vocabulary.add
+                for chunk in appended_chunks(documents, chunk_size):
+                    counts.feed([add(word) for word in tokens.feed(chunk)])
+                counts.feed([add(word) for word in tokens.finish()])
+                models.update(counts)
+            # entries keyed on the old version can no longer be hit
+            if self.cache is not None:
+                self.cache.clear()
+            if snapshot is not None:
+                append_delta(snapshot, first_new, vocabulary.decode(range(first_new, len(vocabulary))), counts,
+                             models.tail)
+        return len(counts.counts)
+
+    def generate_tokens(self, input_text, output_length, seed=None):
+        vocabulary = self.ngram_models.vocabulary
+        end_id = vocabulary.encode([END_OF_TEXT])[0]
+        state = self.start_generation(self.clean_user_input(input_text), seed)
+        stop = 'max_length'
         for _ in range(output_length):
-            prediction = self.predict_next_word_with_attention(sentence)
-            if prediction == '<|endoftext|>':
+            next_id = self.generate_next_id(state)
+            # nothing changes after a miss, so every later step would miss too
+            if next_id == end_id or next_id is None:
+                stop = 'end_of_text' if next_id == end_id else 'no_match'
                 break
-            sentence += ' ' + prediction
-        if cleaned_input in sentence:
-            sentence = sentence.replace(cleaned_input, '', 1).strip()
-        return sentence
+            token = vocabulary.token(next_id)
+            state.push(token, next_id)
+            yield token
+        self.record_stop(state, stop)
+
+    def record_stop(self, state, stop):
+        if self.metrics.enabled:
+            self.metrics.inc('tokens_generated_total', len(state.output))
+            self.metrics.inc('stops_total', reason=stop)
+
+    def predict_sentence_with_attention(self, input_text, output_length, seed=None):
+        return ' '.join(self.generate_tokens(input_text, output_length, seed))
     
     def remove_duplicates(self, text):
      words = text.split()
      unique_words = list(dict.fromkeys(words))
      return ' '.join(unique_words)
 
-    def AskAggmGPT1_5(self, input_text):
+    def format_prompt(self, input_text):
         input_text = str(input_text).lower()
-        raw_response = self.predict_sentence_with_attention(self.user + ": " + input_text.lower() + "\n" + self.ai + ": ", self.max_length)
+        return self.user + ": " + input_text.lower() + "\n" + self.ai + ": "
+
+    def postprocess(self, raw_response):
+        with self.metrics.time('stage_seconds', stage='postprocess'):
+            return self._postprocess(raw_response)
+
+    def _postprocess(self, raw_response):
         raw_response = str(raw_response)
         response = raw_response.replace(self.user + ": ", "").replace(self.ai + ": ", "")
         response = self.remove_duplicates(response)
         response = correct_text(response)
         return response
 
+    def AskAggmGPT1_5(self, input_text, seed=None):
+        with self.metrics.time('request_seconds'):
+            if self.cache is None or isinstance(seed, random.Random):
+                response = self.answer(input_text, seed)
+            else:
+                response = self.cached_answer(input_text, seed)
+        self.metrics.inc('requests_total')
+        return response
+
+    def answer(self, input_text, seed=None):
+        prompt = self.format_prompt(input_text)
+        raw_response = self.predict_sentence_with_attention(prompt, self.max_length, seed)
+        return self.postprocess(raw_response)
+
+    def cached_answer(self, input_text, seed):
+        # Generation only sees the prompt's tokens, so prompts that differ in
+        # case or spacing share an entry.  A seeded answer never changes; the
+        # random module is the same as no seed.  The key holds the model's
+        # version, so an answer generated before add_documents and stored
+        # after it clears the cache is never served.
+        if seed is random:
+            seed = None
+        key = (tuple(self.tokenize(self.clean_user_input(self.format_prompt(input_text)))),
+               self.max_length, seed, self.ngram_models.version)
+        deterministic = seed is not None
+        response = self.cache.lookup(key, deterministic)
+        self.metrics.inc('cache_lookups_total', result='miss' if response is None else 'hit')
+        if response is None:
+            response = self.answer(input_text, seed)
+            self.cache.store(key, response, deterministic)
+        return response
+
+    def AskAggmGPT1_5_batch(self, prompts, seed=None):
+        # Every prompt gets its own Random seeded from one base stream, so a
+        # batch is reproducible for a given seed and each answer is the one
+        # sequential generation with that Random would give.  Each prompt is
+        # a request, answered when the whole batch is.
+        start = time.perf_counter()
+        base = make_rng(seed)
+        vocabulary = self.ngram_models.vocabulary
+        end_id = vocabulary.encode([END_OF_TEXT])[0]
+        encoded = {}
+        states = []
+        for prompt in prompts:
+            if prompt not in encoded:
+                tokens = self.tokenize(self.clean_user_input(self.format_prompt(prompt)))
+                encoded[prompt] = tokens, vocabulary.encode(tokens)
+            tokens, ids = encoded[prompt]
+            rng = random.Random(base.getrandbits(64))
+            states.append(GenerationState(list(tokens), ids, self.maxNgram - 1, rng,
+                                          self.embedding_rng(rng) if self.attention != 'off' else None))
+        matches = {}
+        active = states
+        for _ in range(self.max_length):
+            if not active:
+                break
+            still_active = []
+            for state, next_id in zip(active, self.generate_next_ids(active, matches)):
+                if next_id == end_id or next_id is None:
+                    self.record_stop(state, 'end_of_text' if next_id == end_id else 'no_match')
+                    continue
+                state.push(vocabulary.token(next_id), next_id)
+                still_active.append(state)
+            active = still_active
+        for state in active:
+            self.record_stop(state, 'max_length')
+        responses = {}
+        for state in states:
+            raw_response = ' '.join(state.output)
+            if raw_response not in responses:
+                responses[raw_response] = self.postprocess(raw_response)
+        if self.metrics.enabled:
+            elapsed = time.perf_counter() - start
+            for _ in states:
+                self.metrics.observe('request_seconds', elapsed)
+            self.metrics.inc('requests_total', len(states))
+        return [responses[' '.join(state.output)] for state in states]
+
+    def stream(self, input_text, seed=None):
+        # Yields pieces of the same text AskAggmGPT1_5 returns, as soon as
+        # the post-processing can no longer change them.
+        stages = (StreamingReplace(self.user + ": "), StreamingReplace(self.ai + ": "), StreamingCorrector())
+        separator = ''
+        for token in self.generate_tokens(self.format_prompt(input_text), self.max_length, seed):
+            chunk = separator + token
+            separator = ' '
+            for stage in stages:
+                chunk = stage.feed(chunk)
+            if chunk:
+                yield chunk
+        chunk = ''
+        for stage in stages:
+            chunk = stage.feed(chunk) + stage.finish()
+        if chunk:
+            yield chunk
+
     def run(self):
         while True:
             input_text = input(f'{self.GREEN}\nType a message (type exit to leave): {self.RESET}')
             if input_text.lower() == 'exit':
                 break
-            print(f"{self.BLUE}{self.ModelName}: {self.RESET}", end="")
-            response = self.AskAggmGPT1_5(input_text)
-            print(f"{self.BLUE}{response}{self.RESET}")
+            print(f"{self.BLUE}{self.ModelName}: ", end="", flush=True)
+            for chunk in self.stream(input_text):
+                print(chunk, end="", flush=True)
+            print(self.RESET)
 
 if __name__ == "__main__":
     model = AggmGPT1_5()
@@ -0,0 +1,57 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AggmGPT1_5 import AggmGPT1_5
+
+PROMPTS = ['hi', 'hello', 'how are you', 'what is your name', 'who made you', 'tell me a joke',
+           'what can you do', 'good morning', 'thank you', 'bye']
+
+
+def sequential(model, prompts, seed):
+    # the same per-prompt Random streams AskAggmGPT1_5_batch hands out
+    base = random.Random(seed)
+    responses = []
+    for prompt in prompts:
+        rng = random.Random(base.getrandbits(64))
+        raw = ' '.join(model.generate_tokens(model.format_prompt(prompt), model.max_length, rng))
+        responses.append(model.postprocess(raw))
+    return responses
+
+
+def best_of(repeat, call):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = call()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare batched and sequential generation.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--snapshot', help='load the model from this snapshot instead of training')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    model = AggmGPT1_5.load(args.snapshot) if args.snapshot else AggmGPT1_5()
+    failed = False
+    print(f"\n{'batch':>6}{'sequential s':>14}{'batched s':>12}{'prompts/s':>12}{'speedup':>10}")
+    for size in args.sizes:
+        prompts = [PROMPTS[i % len(PROMPTS)] for i in range(size)]
+        sequential_time, expected = best_of(args.repeat, lambda: sequential(model, prompts, args.seed))
+        batched_time, responses = best_of(args.repeat, lambda: model.AskAggmGPT1_5_batch(prompts, seed=args.seed))
+        failed |= responses != expected
+        print(f'{size:>6}{sequential_time:>14.4f}{batched_time:>12.4f}{size / batched_time:>12.0f}'
+              f'{sequential_time / batched_time:>9.2f}x')
+    if failed:
+        sys.exit('batched responses differ from sequential generation')
+
+
+if __name__ == '__main__':
+    main()
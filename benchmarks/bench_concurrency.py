@@ -0,0 +1,83 @@
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AggmGPT1_5 import AggmGPT1_5
+from cache import ResponseCache
+from metrics import Metrics
+
+PROMPTS = ['hi', 'hello', 'how are you', 'what is your name', 'who made you', 'tell me a joke',
+           'what can you do', 'good morning', 'thank you', 'bye']
+
+
+def gil_enabled():
+    # sys._is_gil_enabled only exists from 3.13 on
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return True if is_gil_enabled is None else is_gil_enabled()
+
+
+def run_threads(model, threads, requests, expected):
+    # Every thread asks the same seeded questions of one shared instance and
+    # checks each answer against the single-threaded one.
+    mismatches = []
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(offset):
+        barrier.wait()
+        for i in range(requests):
+            key = (offset + i) % len(expected)
+            prompt, seed = key % len(PROMPTS), key
+            if model.AskAggmGPT1_5(PROMPTS[prompt], seed=seed) != expected[key]:
+                mismatches.append((PROMPTS[prompt], seed))
+            session = model.session(seed)
+            if session.ask(PROMPTS[prompt]) != expected[key]:
+                mismatches.append((PROMPTS[prompt], seed))
+
+    workers = [threading.Thread(target=worker, args=(t * requests,)) for t in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - start, mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stress one shared model from many threads.')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--requests', type=int, default=500, help='requests per thread')
+    parser.add_argument('--attention', default='incremental')
+    parser.add_argument('--snapshot', help='load the model from this snapshot instead of training')
+    args = parser.parse_args()
+
+    options = {'attention': args.attention, 'metrics': Metrics(), 'cache': ResponseCache(maxsize=64)}
+    model = AggmGPT1_5.load(args.snapshot, **options) if args.snapshot else AggmGPT1_5(**options)
+    reference = AggmGPT1_5(ngram_models=model.ngram_models)
+    expected = [reference.AskAggmGPT1_5(PROMPTS[key % len(PROMPTS)], seed=key)
+                for key in range(max(args.threads) * args.requests)]
+
+    print(f'\nPython {sys.version.split()[0]}, GIL {"enabled" if gil_enabled() else "disabled"}')
+    print(f"{'threads':>8}{'seconds':>10}{'requests/s':>12}{'scaling':>9}")
+    failed = False
+    single = None
+    for threads in args.threads:
+        elapsed, mismatches = run_threads(model, threads, args.requests, expected)
+        rate = 2 * threads * args.requests / elapsed
+        single = single or rate / threads
+        print(f'{threads:>8}{elapsed:>10.3f}{rate:>12.0f}{rate / single:>8.2f}x')
+        failed |= bool(mismatches)
+    calls = model.metrics.counter('requests_total')
+    total = 2 * sum(args.threads) * args.requests
+    if calls != total:
+        sys.exit(f'metrics counted {calls} requests, expected {total}')
+    if failed:
+        sys.exit('concurrent answers differ from single-threaded generation')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AggmGPT1_5 import AggmGPT1_5, np
+from ngram import NgramModel
+
+
+def matrix(rows, cols, rng):
+    return [[rng.uniform(-1, 1) for _ in range(cols)] for _ in range(rows)]
+
+
+def kernel_calls(seq_len, d_model, rng):
+    X = matrix(seq_len, d_model, rng)
+    W = matrix(d_model, d_model, rng)
+    scores = [rng.uniform(-5, 5) for _ in range(seq_len)]
+    num_heads = 1 if seq_len > 25 else max(1, seq_len)
+    return {
+        'mat_mul': lambda m: m.mat_mul(X, W),
+        'softmax': lambda m: m.softmax(scores),
+        'softmax_rows': lambda m: m.softmax_rows(X),
+        'self_attention': lambda m: m.self_attention(X, X, X),
+        'multi_head_attention': lambda m: m.multi_head_attention(X, X, X, num_heads),
+        'positional_encoding': lambda m: m.positional_encoding(seq_len, d_model),
+        'add_positional_encoding': lambda m: m.add_positional_encoding(X, m.positional_encoding(seq_len, d_model)),
+        'feed_forward_network': lambda m: m.feed_forward_network(X),
+    }
+
+
+def max_difference(a, b):
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    if a.shape != b.shape:
+        return float('inf')
+    return float(np.max(np.abs(a - b))) if a.size else 0.0
+
+
+def timed(call, model, min_time):
+    runs, start = 0, time.perf_counter()
+    while True:
+        call(model)
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the pure-Python and NumPy tensor kernels.')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--d-model', type=int, default=3)
+    parser.add_argument('--min-time', type=float, default=0.2)
+    parser.add_argument('--tolerance', type=float, default=1e-9)
+    args = parser.parse_args()
+    if np is None:
+        sys.exit('NumPy is not installed; only the pure-Python backend is available.')
+
+    python = AggmGPT1_5(ngram_models=NgramModel(), backend='python')
+    numpy = AggmGPT1_5(ngram_models=NgramModel(), backend='numpy')
+    failed = False
+    print(f"{'kernel':<26}{'seq_len':>8}{'python s':>12}{'numpy s':>12}{'speedup':>10}{'max diff':>11}")
+    for seq_len in args.lengths:
+        for name, call in kernel_calls(seq_len, args.d_model, random.Random(seq_len)).items():
+            diff = max_difference(call(python), call(numpy))
+            failed |= diff > args.tolerance
+            python_time = timed(call, python, args.min_time)
+            numpy_time = timed(call, numpy, args.min_time)
+            print(f'{name:<26}{seq_len:>8}{python_time:>12.6f}{numpy_time:>12.6f}'
+                  f'{python_time / numpy_time:>9.1f}x{diff:>11.1e}')
+    if failed:
+        sys.exit(f'NumPy kernels differ from the list versions by more than {args.tolerance}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from AggmGPT1_5 import END_OF_TEXT, AggmGPT1_5
+from data import corpus
+
+PROMPTS = ['hi', 'how are you', 'what is your name', 'tell me a joke', 'who made you', 'what can you do']
+
+
+def quiet(call, *args):
+    # training prints a progress bar
+    with contextlib.redirect_stdout(io.StringIO()):
+        return call(*args)
+
+
+def timed(call, min_time, repeat):
+    # the fastest of repeat rounds, each averaging calls over min_time
+    best = float('inf')
+    for _ in range(repeat):
+        runs, start = 0, time.perf_counter()
+        while True:
+            call()
+            runs += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed / runs)
+    return best
+
+
+def best_of(repeat, call):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def metric(value, unit, better='lower'):
+    return {'value': value, 'unit': unit, 'better': better}
+
+
+def scaled_corpus(factor, seed=0, renamed=0.02):
+    # factor shuffled copies of the corpus documents; every copy after the
+    # first renames a share of the vocabulary so the model grows with it
+    rng = random.Random(seed)
+    documents = corpus.split(END_OF_TEXT)
+    vocabulary = sorted(set(corpus.split()))
+    copies = []
+    for copy in range(factor):
+        rng.shuffle(documents)
+        text = END_OF_TEXT.join(documents)
+        if copy:
+            renames = {word: f'{word}{copy}' for word in rng.sample(vocabulary, int(len(vocabulary) * renamed))}
+            text = ' '.join(renames.get(word, word) for word in text.split(' '))
+        copies.append(text)
+    return END_OF_TEXT.join(copies)
+
+
+def bench_import(results, args):
+    code = 'import time; start = time.perf_counter(); import data; print(time.perf_counter() - start)'
+    times = [float(subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True,
+                                  check=True).stdout) for _ in range(args.repeat)]
+    results['import_data'] = metric(min(times), 's')
+
+
+def bench_training(results, args):
+    model = quiet(AggmGPT1_5)
+    results['train_model'] = metric(best_of(args.repeat, lambda: quiet(model.train_model, corpus)), 's')
+    tracemalloc.start()
+    quiet(model.train_model, corpus)
+    results['train_model_peak_memory'] = metric(tracemalloc.get_traced_memory()[1], 'bytes')
+    tracemalloc.stop()
+    results['construct'] = metric(best_of(args.repeat, lambda: quiet(AggmGPT1_5)), 's')
+
+
+def bench_latency(results, args, model):
+    rng = random.Random(0)
+    words = model.tokenize(corpus)
+    for length in args.prompt_lengths:
+        start = rng.randrange(len(words) - length)
+        prompt = ' '.join(words[start:start + length])
+        results[f'predict_next_word[{length}]'] = metric(
+            timed(lambda: model.predict_next_word(prompt, model.ngram_models), args.min_time, args.repeat), 's')
+        results[f'predict_next_word_with_attention[{length}]'] = metric(
+            timed(lambda: model.predict_next_word_with_attention(prompt), args.min_time, args.repeat), 's')
+
+
+def bench_throughput(results, args, model):
+    random.seed(0)
+    calls = tokens = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.min_time * 5:
+        for prompt in PROMPTS:
+            tokens += len(model.AskAggmGPT1_5(prompt).split())
+            calls += 1
+    elapsed = time.perf_counter() - start
+    results['ask_throughput'] = metric(calls / elapsed, 'responses/s', 'higher')
+    results['ask_token_throughput'] = metric(tokens / elapsed, 'tokens/s', 'higher')
+
+
+def bench_scaling(results, args, model):
+    for factor in args.scales:
+        text = scaled_corpus(factor)
+        start = time.perf_counter()
+        trained = quiet(model.train_model, text)
+        elapsed = time.perf_counter() - start
+        results[f'train_model[x{factor}]'] = metric(elapsed, 's')
+        results[f'train_model_tokens_per_second[x{factor}]'] = metric(len(text.split()) / elapsed, 'tokens/s',
+                                                                      'higher')
+        results[f'contexts[x{factor}]'] = metric(len(trained.successors), 'nodes')
+        del trained
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None or not previous['value']:
+            continue
+        change = current['value'] / previous['value'] - 1
+        worse = -change if current['better'] == 'higher' else change
+        flag = ''
+        if worse > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:<48}{previous['value']:>14.6g}{current['value']:>14.6g}{change:>+9.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark training, startup, latency and throughput.')
+    parser.add_argument('--prompt-lengths', type=int, nargs='+', default=[1, 4, 16, 64, 256])
+    parser.add_argument('--scales', type=int, nargs='*', default=[10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.05)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare against a JSON file written by --output')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='relative slowdown that counts as a regression (default 0.25)')
+    args = parser.parse_args()
+
+    model = quiet(AggmGPT1_5)
+    results = {}
+    for name, bench in (('import', bench_import), ('training', bench_training)):
+        print(f'Running {name} benchmarks', file=sys.stderr)
+        bench(results, args)
+    for name, bench in (('latency', bench_latency), ('throughput', bench_throughput), ('scaling', bench_scaling)):
+        print(f'Running {name} benchmarks', file=sys.stderr)
+        bench(results, args, model)
+
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'backend': model.backend,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print(f"\n{'benchmark':<48}{'baseline':>14}{'current':>14}{'change':>9}")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            sys.exit(f'{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AggmGPT1_5 import END_OF_TEXT, AggmGPT1_5
+from bench_suite import scaled_corpus
+from ngram import NgramModel
+
+
+def quiet(call, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return call(*args, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare single-process and sharded parallel training.')
+    parser.add_argument('--scale', type=int, default=30, help='size of the synthetic corpus, in copies of data.py')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument('--shards-per-worker', type=int, default=2)
+    args = parser.parse_args()
+
+    documents = scaled_corpus(args.scale).split(END_OF_TEXT)
+    model = AggmGPT1_5(ngram_models=NgramModel())
+    start = time.perf_counter()
+    expected = quiet(model.train_documents, documents)
+    single = time.perf_counter() - start
+    print(f'\n{os.cpu_count()} CPUs, corpus x{args.scale}, {len(expected.successors)} contexts')
+    print(f"{'workers':>8}{'shards':>8}{'seconds':>10}{'speedup':>10}")
+    print(f"{'single':>8}{1:>8}{single:>10.3f}{1:>9.2f}x")
+    failed = False
+    for workers in args.workers:
+        shards = workers * args.shards_per_worker
+        start = time.perf_counter()
+        trained = quiet(model.train_parallel, documents, workers, shards)
+        elapsed = time.perf_counter() - start
+        failed |= trained != expected
+        print(f'{workers:>8}{shards:>8}{elapsed:>10.3f}{single / elapsed:>9.2f}x')
+    if failed:
+        sys.exit('parallel training differs from single-process training')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Entry:
+    __slots__ = ('responses', 'next', 'expires')
+
+    def __init__(self, expires):
+        self.responses = []
+        self.next = 0
+        self.expires = expires
+
+
+class ResponseCache:
+    # An LRU cache of finished responses with an optional time to live.
+    # With variants > 1 each key collects that many sampled responses before
+    # it starts answering from the cache, then rotates through them.
+    def __init__(self, maxsize=1024, ttl=None, variants=1, clock=time.monotonic):
+        if maxsize < 1:
+            raise ValueError(f'maxsize must be at least 1, got {maxsize}')
+        if variants < 1:
+            raise ValueError(f'variants must be at least 1, got {variants}')
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.variants = variants
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key, deterministic=False):
+        # A cached response, or None when the caller should generate one and
+        # store it.  Deterministic keys always give the same response, so
+        # one is enough however many variants are configured.
+        wanted = 1 if deterministic else self.variants
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires is not None and entry.expires <= self.clock():
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None or len(entry.responses) < wanted:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            response = entry.responses[entry.next % len(entry.responses)]
+            entry.next += 1
+            return response
+
+    def store(self, key, response, deterministic=False):
+        wanted = 1 if deterministic else self.variants
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                expires = None if self.ttl is None else self.clock() + self.ttl
+                entry = self.entries[key] = _Entry(expires)
+            if len(entry.responses) < wanted:
+                entry.responses.append(response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
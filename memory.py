@@ -0,0 +1,103 @@
+import argparse
+import json
+import sys
+
+from snapshot import read_snapshot
+
+
+class _Sizer:
+    # sys.getsizeof over an object and what it holds, counting each object
+    # once, so ints and strings shared between contexts are not counted twice
+    def __init__(self):
+        self.seen = set()
+
+    def __call__(self, *objects):
+        size = 0
+        stack = list(objects)
+        while stack:
+            obj = stack.pop()
+            if obj is None or id(obj) in self.seen:
+                continue
+            self.seen.add(id(obj))
+            size += sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                stack.extend(obj.keys())
+                stack.extend(obj.values())
+            elif isinstance(obj, (list, tuple)):
+                stack.extend(obj)
+        return size
+
+
+def memory_report(model, top=10):
+    # Per order (context length + 1): contexts with successors, successor
+    # entries, distinct next words and deep bytes.  A node's bytes are its
+    # Successors, its slot in the successor list and the edge leading to
+    # it, with the edge dict's table shared out evenly over its entries.
+    if not hasattr(model, 'walk'):
+        raise TypeError('memory_report needs an in-memory NgramModel; load the snapshot without mapped=True')
+    sizer = _Sizer()
+    vocabulary = model.vocabulary
+    vocabulary_bytes = sizer(vocabulary.tokens, vocabulary.ids)
+    edge_slot = (sys.getsizeof(model.edges) - sys.getsizeof({})) / max(len(model.edges), 1)
+    list_slot = (sys.getsizeof(model.successors) - sys.getsizeof([])) / max(len(model.successors), 1)
+    parents = {child: key for key, child in model.edges.items()}
+    orders = {}
+    heaviest = []
+    for context, node in model.walk():
+        order = orders.setdefault(len(context) + 1, {'contexts': 0, 'entries': 0, 'unique_successors': set(),
+                                                    'bytes': 0.0})
+        successors = model.successors[node]
+        size = sizer(successors) + list_slot
+        if node in parents:
+            size += sizer(parents[node], node) + edge_slot
+        order['bytes'] += size
+        if successors is None:
+            continue
+        words = successors.words
+        order['contexts'] += 1
+        order['entries'] += len(words)
+        order['unique_successors'].update(words)
+        heaviest.append((size, len(words), context))
+    for order in orders.values():
+        order['unique_successors'] = len(order['unique_successors'])
+        order['bytes'] = round(order['bytes'])
+    heaviest.sort(key=lambda item: (-item[0], item[2]))
+    return {
+        'vocabulary': {'tokens': len(vocabulary), 'bytes': vocabulary_bytes},
+        'orders': dict(sorted(orders.items())),
+        'total_bytes': vocabulary_bytes + sum(order['bytes'] for order in orders.values()),
+        'heaviest': [{'context': ' '.join(vocabulary.decode(context)), 'order': len(context) + 1,
+                      'entries': entries, 'bytes': round(size)} for size, entries, context in heaviest[:top]],
+    }
+
+
+def print_report(report):
+    vocabulary = report['vocabulary']
+    print(f"vocabulary: {vocabulary['tokens']} tokens, {vocabulary['bytes']} bytes")
+    print(f"{'order':>5}{'contexts':>12}{'entries':>12}{'unique':>10}{'bytes':>14}")
+    for n, order in report['orders'].items():
+        print(f"{n:>5}{order['contexts']:>12}{order['entries']:>12}{order['unique_successors']:>10}"
+              f"{order['bytes']:>14}")
+    print(f"total: {report['total_bytes']} bytes")
+    print('heaviest contexts:')
+    for context in report['heaviest']:
+        text = repr(context['context']) if context['context'] else '(no context)'
+        print(f"{context['bytes']:>10} bytes {context['entries']:>6} entries  order {context['order']}  {text}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the memory footprint of an AggmGPT-1.5 snapshot.')
+    parser.add_argument('snapshot')
+    parser.add_argument('--top', type=int, default=10, help='heaviest contexts to list')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+    # the corpus is not checked, so snapshots of other corpora can be sized too
+    report = memory_report(read_snapshot(args.snapshot, None), args.top)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
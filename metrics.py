@@ -0,0 +1,131 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+HELP = {
+    'tokens_generated_total': 'Tokens generated.',
+    'backoff_order_total': 'Generation steps by the n-gram order that produced the token.',
+    'stops_total': 'Finished generations by the reason generation stopped.',
+    'requests_total': 'Prompts answered by AskAggmGPT1_5 or AskAggmGPT1_5_batch.',
+    'cache_lookups_total': 'Response cache lookups by result.',
+    'request_seconds': 'Time to answer a prompt; a batch takes as long for each of its prompts.',
+    'stage_seconds': 'Time spent in each generation stage.',
+    'training_phase_seconds': 'Time spent in each train_model phase.',
+}
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class NullMetrics:
+    # The default: per-token code checks enabled before measuring anything,
+    # so instrumentation costs one attribute lookup when it is off.
+    enabled = False
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def time(self, name, **labels):
+        return _NULL_TIMER
+
+    def export(self):
+        return ''
+
+
+class Metrics(NullMetrics):
+    # Counters and histograms keyed by metric name and label values, exported
+    # in the Prometheus text format.
+    enabled = True
+
+    def __init__(self, namespace='aggmgpt', buckets=DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = name, tuple(sorted(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = name, tuple(sorted(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # one count per bucket, then +Inf, then the sum
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name, **labels):
+        # (count, sum) of a histogram
+        histogram = self.histograms.get((name, tuple(sorted(labels.items()))))
+        return (0, 0.0) if histogram is None else (sum(histogram[:-1]), histogram[-1])
+
+    def export(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        lines = []
+        for kind, series in (('counter', counters), ('histogram', histograms)):
+            for name in sorted({name for name, _ in series}):
+                full_name = f'{self.namespace}_{name}'
+                if name in HELP:
+                    lines.append(f'# HELP {full_name} {HELP[name]}')
+                lines.append(f'# TYPE {full_name} {kind}')
+                for (series_name, labels), value in sorted(series.items()):
+                    if series_name != name:
+                        continue
+                    if kind == 'counter':
+                        lines.append(f'{full_name}{_labels(labels)} {value}')
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + (float('inf'),), value):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{full_name}_bucket{_labels(labels + (("le", le),))} {cumulative}')
+                    lines.append(f'{full_name}_sum{_labels(labels)} {value[-1]}')
+                    lines.append(f'{full_name}_count{_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+NULL_METRICS = NullMetrics()
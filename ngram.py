@@ -0,0 +1,272 @@
+import random
+import time
+from bisect import bisect_right
+from itertools import accumulate, islice, repeat
+from operator import sub
+
+
+class Successors(tuple):
+    # One flat tuple per context: the unique next words in first-seen order,
+    # followed by their cumulative counts, so sampling is a bisect over the
+    # second half without any per-call allocation.
+    __slots__ = ()
+
+    @classmethod
+    def from_counts(cls, counts):
+        return cls(tuple(counts) + tuple(accumulate(counts.values())))
+
+    @classmethod
+    def from_arrays(cls, words, cumulative):
+        return cls(tuple(words) + tuple(cumulative))
+
+    def merge(self, counts):
+        # A new Successors with counts added after this one's.  Only the
+        # added words are visited in Python; the rest is copied wholesale.
+        half = len(self) // 2
+        words = list(self[:half])
+        totals = list(map(sub, self[half:], (0,) + self[half:-1]))
+        index = dict(zip(words, range(half)))
+        for next_id, count in counts.items():
+            i = index.get(next_id)
+            if i is None:
+                index[next_id] = len(words)
+                words.append(next_id)
+                totals.append(count)
+            else:
+                totals[i] += count
+        return Successors(tuple(words) + tuple(accumulate(totals)))
+
+    @property
+    def words(self):
+        return self[:len(self) // 2]
+
+    @property
+    def cumulative(self):
+        return self[len(self) // 2:]
+
+    @property
+    def total(self):
+        return self[-1] if self else 0
+
+    def items(self):
+        half = len(self) // 2
+        previous = 0
+        for i in range(half):
+            yield self[i], self[half + i] - previous
+            previous = self[half + i]
+
+    def sample(self, rng=random):
+        half = len(self) // 2
+        return self[bisect_right(self, rng.randrange(self[-1]), half) - half]
+
+
+UNKNOWN = -1
+
+
+class Vocabulary:
+    def __init__(self, tokens=()):
+        self.tokens = []
+        self.ids = {}
+        for token in tokens:
+            self.add(token)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __eq__(self, other):
+        return isinstance(other, Vocabulary) and self.tokens == other.tokens
+
+    def add(self, token):
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+    def encode(self, words):
+        get = self.ids.get
+        return [get(word, UNKNOWN) for word in words]
+
+    def token(self, token_id):
+        return self.tokens[token_id]
+
+    def decode(self, ids):
+        return [self.tokens[i] for i in ids]
+
+
+class NgramCounts:
+    # context tuple of token ids -> {next id: count}, for every order at once
+    def __init__(self, min_order=1, max_order=5):
+        self.min_order = min_order
+        self.max_order = max_order
+        self.counts = {}
+        self.carry = []
+
+    def add(self, ids, first=0, final=True):
+        # Counts every window whose next token is at index first or later.
+        # When ids run to the end of the text the last token is never
+        # counted as a next token.
+        counts = self.counts
+        for n in range(self.min_order, self.max_order + 1):
+            begin = max(first, n - 1)
+            stop = len(ids) - final - begin
+            if stop <= 0:
+                continue
+            start = begin - n + 1
+            contexts = zip(*[ids[start + k:start + k + stop] for k in range(n - 1)]) if n > 1 else repeat((), stop)
+            for context, next_id in zip(contexts, ids[begin:begin + stop]):
+                successors = counts.get(context)
+                if successors is None:
+                    successors = counts[context] = {}
+                successors[next_id] = successors.get(next_id, 0) + 1
+
+    def feed(self, ids):
+        # add() for a token stream that arrives in pieces.  The last max_order
+        # tokens carry over so windows span the boundaries, and the newest
+        # token waits for a successor, so the result equals one add() call
+        # over the whole stream.
+        buffer = self.carry + list(ids)
+        self.add(buffer, len(self.carry) - 1 if self.carry else 0)
+        self.carry = buffer[-self.max_order:]
+
+    def add_boundary(self, left, ids, final=False):
+        # Only the windows whose next token is in ids and whose context
+        # reaches back into left, the tokens just before ids.
+        counts = self.counts
+        buffer = list(left) + list(ids)
+        for j in range(len(left), len(buffer) - final):
+            for n in range(max(self.min_order, j - len(left) + 2), min(self.max_order, j + 1) + 1):
+                context = tuple(buffer[j - n + 1:j])
+                successors = counts.get(context)
+                if successors is None:
+                    successors = counts[context] = {}
+                successors[buffer[j]] = successors.get(buffer[j], 0) + 1
+
+    def merge(self, other, mapping=None):
+        # Adds other's counts after this table's.  Successors keep their
+        # first-seen order, so merging the partial tables of consecutive
+        # pieces of text, in order, gives the table of the whole text.
+        # mapping translates other's token ids into this table's.
+        counts = self.counts
+        for context, successors in other.counts.items():
+            if mapping is not None:
+                context = tuple([mapping[i] for i in context])
+                successors = {mapping[i]: count for i, count in successors.items()}
+            target = counts.get(context)
+            if target is None:
+                counts[context] = dict(successors)
+                continue
+            for next_id, count in successors.items():
+                target[next_id] = target.get(next_id, 0) + count
+
+
+class NgramModel:
+    # A trie over reversed contexts, stored flat.  Node ids index successors,
+    # and edges maps (node << 32 | token id) to the child node holding the same
+    # context with that token prepended, so one walk from the most recent token
+    # backwards visits every order's context.  The node at depth k holds the
+    # (k + 1)-gram successors, or None.
+    # tail holds the last max_order token ids of the training text, the last
+    # of which has not been counted as a next token yet, so update() can
+    # continue the text where training stopped.  version is odd while
+    # update() is writing; lookups that overlap a write are retried.  digest
+    # is the snapshot digest of the text and settings the tables were
+    # trained with, when that is known.
+    def __init__(self, vocabulary=None, max_order=5, edges=None, successors=None, root=0, tail=()):
+        self.vocabulary = Vocabulary() if vocabulary is None else vocabulary
+        self.max_order = max_order
+        self.edges = {} if edges is None else edges
+        self.successors = [None] if successors is None else successors
+        self.root = root
+        self.tail = list(tail)
+        self.version = 0
+        self.digest = None
+
+    @classmethod
+    def from_counts(cls, vocabulary, counts):
+        model = cls(vocabulary, counts.max_order, tail=counts.carry)
+        for context, successors in counts.counts.items():
+            model.successors[model.node(context, create=True)] = Successors.from_counts(successors)
+        return model
+
+    def __eq__(self, other):
+        return (isinstance(other, NgramModel) and self.vocabulary == other.vocabulary
+                and self.max_order == other.max_order and dict(self.contexts()) == dict(other.contexts()))
+
+    def node(self, context, create=False):
+        edges = self.edges
+        node = self.root
+        for token_id in reversed(context):
+            child = edges.get(node << 32 | token_id)
+            if child is None:
+                if not create or token_id < 0:
+                    return None
+                # the slot exists before the edge that leads to it, so a
+                # reader that follows the edge can always index it
+                child = len(self.successors)
+                self.successors.append(None)
+                edges[node << 32 | token_id] = child
+            node = child
+        return node
+
+    def lookup(self, context):
+        while True:
+            version = self.version
+            node = self.node(context)
+            found = None if node is None else self.successors[node]
+            if version == self.version and not version & 1:
+                return found
+            time.sleep(0)
+
+    def longest_match(self, context, max_depth):
+        edges, successors = self.edges, self.successors
+        while True:
+            version = self.version
+            node = self.root
+            depth, best = 0, successors[node]
+            for d, token_id in enumerate(islice(reversed(context), max_depth), 1):
+                node = edges.get(node << 32 | token_id)
+                if node is None:
+                    break
+                if successors[node] is not None:
+                    depth, best = d, successors[node]
+            if version == self.version and not version & 1:
+                return depth, best
+            time.sleep(0)
+
+    def update(self, counts):
+        # Adds the counts of text that continues the training text, touching
+        # only their contexts.  The merged successors are worked out first,
+        # then written, with new nodes, while version is odd, so every lookup
+        # sees either the old tables or the new ones.  Calls must not overlap.
+        successors = self.successors
+        changes = []
+        for context, added in counts.counts.items():
+            node = self.node(context)
+            current = None if node is None else successors[node]
+            changes.append((context, node, Successors.from_counts(added) if current is None else current.merge(added)))
+        self.version += 1
+        try:
+            for context, node, merged in changes:
+                successors[self.node(context, create=True) if node is None else node] = merged
+            self.tail = list(counts.carry)
+        finally:
+            self.version += 1
+
+    def walk(self):
+        contexts = {self.root: ()}
+        parents = {child: key for key, child in self.edges.items()}
+
+        def context(node):
+            if node not in contexts:
+                key = parents[node]
+                contexts[node] = (key & 0xFFFFFFFF,) + context(key >> 32)
+            return contexts[node]
+
+        for node in range(len(self.successors)):
+            yield context(node), node
+
+    def contexts(self):
+        for context, node in self.walk():
+            if self.successors[node] is not None:
+                yield context, self.successors[node]
@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import gc
+import os
+import select
+import signal
+import socket
+import time
+
+from AggmGPT1_5 import AggmGPT1_5
+from metrics import Metrics
+from server import Server, add_cache_arguments, make_cache
+
+HEARTBEAT_INTERVAL = 1.0
+
+
+def run_worker(model, sock, heartbeat_fd, server_options):
+    # The heartbeat is written from the event loop, so a worker whose loop is
+    # stuck stops beating even though its process is still alive.  A broken
+    # pipe means the parent is gone, and the worker shuts down as if it had
+    # been sent SIGTERM rather than serve on as an orphan.
+    async def serve():
+        async def beat():
+            while True:
+                try:
+                    os.write(heartbeat_fd, b'.')
+                except BlockingIOError:
+                    pass
+                except BrokenPipeError:
+                    os.kill(os.getpid(), signal.SIGTERM)
+                    return
+                await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+        heartbeat = asyncio.create_task(beat())
+        try:
+            await Server(model, **server_options).serve_forever(sock)
+        finally:
+            heartbeat.cancel()
+
+    asyncio.run(serve())
+
+
+class Worker:
+    def __init__(self, pid, heartbeat_fd):
+        self.pid = pid
+        self.heartbeat_fd = heartbeat_fd
+        self.started = self.last_beat = time.monotonic()
+
+
+class WorkerPool:
+    # The parent owns the model and the listening socket and never serves.
+    # Workers are forked from it, so they share the model's pages
+    # copy-on-write and the kernel spreads accepted connections across them.
+    def __init__(self, model, sock, workers=os.cpu_count(), heartbeat_timeout=10.0, freeze=True,
+                 shutdown_timeout=30.0, **server_options):
+        self.model = model
+        self.sock = sock
+        self.size = workers
+        self.heartbeat_timeout = heartbeat_timeout
+        self.freeze = freeze
+        self.shutdown_timeout = shutdown_timeout
+        self.server_options = dict(server_options, shutdown_timeout=shutdown_timeout)
+        self.workers = {}
+        self.stopping = False
+
+    def spawn(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.close(read_fd)
+                for worker in self.workers.values():
+                    os.close(worker.heartbeat_fd)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                os.set_blocking(write_fd, False)
+                run_worker(self.model, self.sock, write_fd, self.server_options)
+                status = 0
+            finally:
+                os._exit(status)
+        os.close(write_fd)
+        self.workers[pid] = Worker(pid, read_fd)
+        return pid
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def run(self):
+        if self.freeze:
+            # Move everything allocated so far, the model included, out of the
+            # collector's reach so collections in the workers do not write
+            # to those objects and dirty the shared pages.
+            gc.collect()
+            gc.freeze()
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for _ in range(self.size):
+            self.spawn()
+        while not self.stopping:
+            self.check_heartbeats()
+            self.reap(restart=True)
+        self.shutdown()
+
+    def check_heartbeats(self):
+        fds = {worker.heartbeat_fd: worker for worker in self.workers.values()}
+        try:
+            readable, _, _ = select.select(list(fds), [], [], HEARTBEAT_INTERVAL)
+        except InterruptedError:
+            return
+        now = time.monotonic()
+        for fd in readable:
+            if os.read(fd, 4096):
+                fds[fd].last_beat = now
+        for worker in self.workers.values():
+            if now - worker.last_beat > self.heartbeat_timeout:
+                print(f'Worker {worker.pid} missed its heartbeat; killing it')
+                self.kill(worker.pid, signal.SIGKILL)
+
+    def reap(self, restart):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker.heartbeat_fd)
+            if restart and not self.stopping:
+                print(f'Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}; restarting it')
+                # a worker that dies straight away would otherwise fork in a tight loop
+                if time.monotonic() - worker.started < HEARTBEAT_INTERVAL:
+                    time.sleep(HEARTBEAT_INTERVAL)
+                self.spawn()
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def shutdown(self):
+        # Workers finish their running requests on SIGTERM; any still alive
+        # after the shutdown timeout are killed.
+        for pid in list(self.workers):
+            self.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.shutdown_timeout + HEARTBEAT_INTERVAL
+        while self.workers and time.monotonic() < deadline:
+            self.reap(restart=False)
+            time.sleep(0.05)
+        for pid in list(self.workers):
+            self.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            os.close(self.workers.pop(pid).heartbeat_fd)
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve AggmGPT-1.5 from a pool of pre-forked worker processes.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--snapshot', help='load the model from this snapshot, training and writing it if needed')
+    parser.add_argument('--mapped', action='store_true',
+                        help='memory-map the snapshot so workers read the model from the shared page cache')
+    parser.add_argument('--no-freeze', dest='freeze', action='store_false',
+                        help='do not gc.freeze() the model before forking')
+    parser.add_argument('--concurrency', type=int, default=4, help='generations allowed to run at once per worker')
+    parser.add_argument('--keep-alive-timeout', type=float, default=5.0)
+    parser.add_argument('--shutdown-timeout', type=float, default=30.0)
+    parser.add_argument('--heartbeat-timeout', type=float, default=10.0)
+    parser.add_argument('--metrics', action='store_true',
+                        help='record metrics and export them on /metrics; each worker reports its own')
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+    metrics = Metrics() if args.metrics else None
+    if args.mapped:
+        if not args.snapshot:
+            parser.error('--mapped requires --snapshot')
+        # trains and writes the snapshot if it is missing or stale
+        AggmGPT1_5(snapshot=args.snapshot)
+        model = AggmGPT1_5.load(args.snapshot, mapped=True, metrics=metrics, cache=make_cache(args))
+    else:
+        model = AggmGPT1_5(snapshot=args.snapshot, metrics=metrics, cache=make_cache(args))
+    sock = socket.create_server((args.host, args.port), backlog=1024)
+    pool = WorkerPool(model, sock, args.workers, args.heartbeat_timeout, args.freeze, args.shutdown_timeout,
+                      concurrency=args.concurrency, keep_alive_timeout=args.keep_alive_timeout)
+    print(f'Serving {model.ModelName} on http://{args.host}:{args.port} with {args.workers} workers')
+    pool.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import argparse
+import math
+import os
+import random
+import tempfile
+
+from AggmGPT1_5 import AggmGPT1_5
+from data import corpus
+from ngram import NgramCounts, NgramModel
+from snapshot import SnapshotError, read_snapshot, write_snapshot
+from training import END_OF_TEXT
+
+
+class Pruning:
+    # Which n-grams to drop.  An order is the context length plus one.
+    # min_count and top_k take one value for every order above 1, or a dict
+    # by order; the unigram table is only pruned when a dict names order 1.
+    #   min_count: drop successors seen fewer times than this
+    #   top_k: keep only the k most frequent successors of a context
+    #   threshold: drop contexts whose distribution is so close to the one
+    #     they back off to that frequency * KL divergence is below this
+    # Contexts are judged against the unpruned tables, so the result does
+    # not depend on the order they are visited in.  Generation never backs
+    # off from a one-word context to the unigram table, so those contexts
+    # are never dropped: they keep at least their most frequent successor.
+    def __init__(self, min_count=None, top_k=None, threshold=None):
+        limits = top_k.values() if isinstance(top_k, dict) else [] if top_k is None else [top_k]
+        if any(k < 1 for k in limits):
+            raise ValueError(f'top_k must be at least 1, got {top_k}')
+        self.min_count = min_count
+        self.top_k = top_k
+        self.threshold = threshold
+
+    def settings(self):
+        # a stable description for snapshots; pruning nothing is no pruning
+        if self.min_count is None and self.top_k is None and self.threshold is None:
+            return ''
+        min_count, top_k = (sorted(option.items()) if isinstance(option, dict) else option
+                            for option in (self.min_count, self.top_k))
+        return f'pruning min_count={min_count!r} top_k={top_k!r} threshold={self.threshold!r}'
+
+    @staticmethod
+    def limit(option, order):
+        if isinstance(option, dict):
+            return option.get(order)
+        return option if order > 1 else None
+
+    def prune_counts(self, counts):
+        table = counts.counts
+        total = sum(table[()].values()) if () in table else 0
+        pruned = NgramCounts(counts.min_order, counts.max_order)
+        pruned.carry = list(counts.carry)
+        for context, successors in table.items():
+            order = len(context) + 1
+            if (self.threshold is not None and len(context) > 1 and context[1:] in table
+                    and self.weighted_divergence(successors, table[context[1:]], total) < self.threshold):
+                continue
+            min_count = self.limit(self.min_count, order)
+            if min_count is not None:
+                kept = {next_id: count for next_id, count in successors.items() if count >= min_count}
+                if not kept and len(context) <= 1:
+                    best = max(successors, key=successors.get)
+                    kept = {best: successors[best]}
+                successors = kept
+            top_k = self.limit(self.top_k, order)
+            if top_k is not None and len(successors) > top_k:
+                # most frequent first, earlier first among equals, then back
+                # in first-seen order
+                ranked = sorted(successors, key=successors.get, reverse=True)[:top_k]
+                kept = set(ranked)
+                successors = {next_id: count for next_id, count in successors.items() if next_id in kept}
+            if successors:
+                pruned.counts[context] = successors
+        return pruned
+
+    @staticmethod
+    def weighted_divergence(successors, backoff, total):
+        # P(context) * KL(P(. | context) || P(. | backoff context)).  In an
+        # already pruned model a successor can be missing from the backoff;
+        # then q is 0, the divergence infinite and the context is kept.
+        count = sum(successors.values())
+        backoff_count = sum(backoff.values())
+        divergence = 0.0
+        for next_id, n in successors.items():
+            if next_id not in backoff:
+                return math.inf
+            p = n / count
+            divergence += p * math.log(p * backoff_count / backoff[next_id])
+        return count / total * divergence if total else 0.0
+
+    def prune_model(self, model):
+        # the offline pass, on a trained NgramModel
+        counts = NgramCounts(max_order=model.max_order)
+        counts.counts = {context: dict(successors.items()) for context, successors in model.contexts()}
+        counts.carry = list(model.tail)
+        return NgramModel.from_counts(model.vocabulary, self.prune_counts(counts))
+
+
+def entry_count(model):
+    return sum(len(successors) // 2 for _, successors in model.contexts())
+
+
+def same_distribution(a, b):
+    # the same next-word probabilities, whatever the counts behind them
+    if a is None or b is None:
+        return a is b
+    a, b = dict(a.items()), dict(b.items())
+    total_a, total_b = sum(a.values()), sum(b.values())
+    return a.keys() == b.keys() and all(a[w] * total_b == b[w] * total_a for w in a)
+
+
+def snapshot_size(model):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'model.aggm')
+        write_snapshot(path, model, corpus)
+        return os.path.getsize(path)
+
+
+def default_prompts(count=100, seed=0):
+    prompts = sorted({line[len('user:'):].strip() for line in corpus.splitlines() if line.startswith('user:')})
+    return random.Random(seed).sample(prompts, min(count, len(prompts)))
+
+
+def pruning_report(original, pruned, prompts=None, seeds=range(3)):
+    # Memory saved against how often generation changes: the share of
+    # seeded answers that differ, and the share of steps, along the
+    # unpruned model's own generations, at which the pruned model would
+    # sample from a different distribution.
+    prompts = default_prompts() if prompts is None else prompts
+    before = AggmGPT1_5(ngram_models=original)
+    after = AggmGPT1_5(ngram_models=pruned)
+    end_id = original.vocabulary.encode([END_OF_TEXT])[0]
+    answers = changed = steps = changed_steps = 0
+    for prompt in prompts:
+        for seed in seeds:
+            answers += 1
+            changed += before.AskAggmGPT1_5(prompt, seed) != after.AskAggmGPT1_5(prompt, seed)
+            state = before.start_generation(before.clean_user_input(before.format_prompt(prompt)), seed)
+            for _ in range(before.max_length):
+                match = original.longest_match(state.context, before.maxNgram - 1)
+                pruned_match = pruned.longest_match(state.context, before.maxNgram - 1)
+                steps += 1
+                changed_steps += not same_distribution(match[1], pruned_match[1])
+                next_id = before.sample_match(match, state.length, state.rng)
+                if next_id is None or next_id == end_id:
+                    break
+                state.push(original.vocabulary.token(next_id), next_id)
+    report = {}
+    for name, model in (('before', original), ('after', pruned)):
+        report[name] = {'contexts': sum(1 for _ in model.contexts()), 'entries': entry_count(model),
+                        'snapshot_bytes': snapshot_size(model)}
+    report['bytes_saved'] = 1 - report['after']['snapshot_bytes'] / report['before']['snapshot_bytes']
+    report['answers_changed'] = changed / answers if answers else 0.0
+    report['steps_changed'] = changed_steps / steps if steps else 0.0
+    return report
+
+
+def print_report(report):
+    print(f"{'':<16}{'contexts':>12}{'entries':>12}{'bytes':>14}")
+    for name in ('before', 'after'):
+        row = report[name]
+        print(f"{name:<16}{row['contexts']:>12}{row['entries']:>12}{row['snapshot_bytes']:>14}")
+    print(f"memory saved    {report['bytes_saved']:.1%}")
+    print(f"answers changed {report['answers_changed']:.1%}")
+    print(f"steps changed   {report['steps_changed']:.1%}")
+
+
+def per_order(value):
+    # '2' for every order above 1, or '5=2' for one order
+    if '=' not in value:
+        return int(value)
+    order, _, limit = value.partition('=')
+    return {int(order): int(limit)}
+
+
+def merged_option(parser, values):
+    if not values:
+        return None
+    if len(values) == 1 and not isinstance(values[0], dict):
+        return values[0]
+    option = {}
+    for value in values:
+        if not isinstance(value, dict):
+            parser.error('give either one limit for every order or ORDER=N limits')
+        option.update(value)
+    return option
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prune an AggmGPT-1.5 snapshot and report what it changes.')
+    parser.add_argument('snapshot', help='snapshot to prune; trained and written first if missing')
+    parser.add_argument('output', nargs='?', help='write the pruned snapshot here')
+    parser.add_argument('--min-count', type=per_order, nargs='+', default=[],
+                        help='minimum successor count, for every order above 1 (N) or per order (ORDER=N)')
+    parser.add_argument('--top-k', type=per_order, nargs='+', default=[],
+                        help='successors kept per context, for every order above 1 (K) or per order (ORDER=K)')
+    parser.add_argument('--threshold', type=float, help='weighted KL divergence below which contexts are dropped')
+    parser.add_argument('--prompts', type=int, default=100, help='corpus prompts to compare generation on')
+    parser.add_argument('--seeds', type=int, default=3, help='seeds per prompt')
+    args = parser.parse_args()
+    pruning = Pruning(merged_option(parser, args.min_count), merged_option(parser, args.top_k), args.threshold)
+    if not os.path.exists(args.snapshot):
+        AggmGPT1_5(snapshot=args.snapshot)
+    # Any snapshot can be pruned, including one this wrote.  Only pruning an
+    # unpruned corpus snapshot gives what training with these options would,
+    # so the output of any other is recorded as matching no training run.
+    settings = pruning.settings()
+    try:
+        try:
+            original = read_snapshot(args.snapshot, corpus)
+        except SnapshotError:
+            original = read_snapshot(args.snapshot, None)
+            settings = f'repruned {settings}'
+    except (OSError, SnapshotError) as e:
+        parser.error(f'cannot read {args.snapshot}: {e}')
+    pruned = pruning.prune_model(original)
+    print_report(pruning_report(original, pruned, default_prompts(args.prompts), range(args.seeds)))
+    if args.output:
+        write_snapshot(args.output, pruned, corpus, settings)
+
+
+if __name__ == '__main__':
+    main()
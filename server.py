@@ -0,0 +1,323 @@
+import argparse
+import asyncio
+import json
+import re
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+from AggmGPT1_5 import AggmGPT1_5
+from cache import ResponseCache
+from metrics import Metrics
+
+MAX_HEADER_BYTES = 16 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or status.phrase)
+        self.status = status
+
+
+class Request:
+    def __init__(self, method, target, version, headers, body):
+        url = urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def params(self):
+        # JSON body for POST, query string for GET
+        if self.method == 'POST':
+            try:
+                params = json.loads(self.body or b'{}')
+            except ValueError:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, 'body is not valid JSON')
+            if not isinstance(params, dict):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, 'body must be a JSON object')
+            return params
+        return self.query
+
+
+async def read_request(reader):
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise HTTPError(HTTPStatus.BAD_REQUEST)
+        return None
+    except asyncio.LimitOverrunError:
+        raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split()
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST)
+    if version not in ('HTTP/1.0', 'HTTP/1.1'):
+        raise HTTPError(HTTPStatus.HTTP_VERSION_NOT_SUPPORTED)
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        raise HTTPError(HTTPStatus.NOT_IMPLEMENTED, 'chunked request bodies are not supported')
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST)
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    body = await reader.readexactly(length) if length else b''
+    return Request(method, target, version, headers, body)
+
+
+def response_head(status, headers, keep_alive):
+    lines = [f'HTTP/1.1 {status.value} {status.phrase}']
+    lines += [f'{name}: {value}' for name, value in headers.items()]
+    lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+def json_response(status, payload, keep_alive):
+    body = json.dumps(payload).encode('utf-8')
+    headers = {'Content-Type': 'application/json', 'Content-Length': len(body)}
+    return response_head(status, headers, keep_alive) + body
+
+
+def sse_event(data, event=None):
+    text = f'event: {event}\n' if event else ''
+    text += f'data: {json.dumps(data)}\n\n'
+    return text.encode('utf-8')
+
+
+def http_chunk(data):
+    return f'{len(data):X}\r\n'.encode('ascii') + data + b'\r\n'
+
+
+class Server:
+    # Generation is CPU-bound, so it runs on a thread pool and the event
+    # loop only parses requests and writes responses.  The semaphore bounds
+    # how many generations run at once; further requests wait for a slot.
+    def __init__(self, model, host='127.0.0.1', port=8000, concurrency=4, keep_alive_timeout=5.0,
+                 shutdown_timeout=30.0):
+        self.model = model
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.keep_alive_timeout = keep_alive_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='generate')
+        self.server = None
+        self.slots = None
+        self.connections = set()
+        self.busy = set()
+        self.closing = False
+        self.routes = {
+            '/generate': self.generate,
+            '/stream': self.stream,
+            '/health': self.health,
+            '/metrics': self.metrics,
+        }
+
+    async def start(self, sock=None):
+        self.slots = asyncio.Semaphore(self.concurrency)
+        if sock is not None:
+            self.server = await asyncio.start_server(self.handle_connection, sock=sock, limit=MAX_HEADER_BYTES)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                                     limit=MAX_HEADER_BYTES)
+        return self.server
+
+    async def serve_forever(self, sock=None):
+        await self.start(sock)
+        loop = asyncio.get_running_loop()
+        stopped = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopped.set)
+        async with self.server:
+            await stopped.wait()
+            await self.shutdown()
+
+    async def shutdown(self):
+        # Stop accepting, drop idle keep-alive connections and give requests
+        # that are already running shutdown_timeout seconds to finish.
+        self.closing = True
+        self.server.close()
+        for task in self.connections - self.busy:
+            task.cancel()
+        if self.connections:
+            await asyncio.wait(self.connections, timeout=self.shutdown_timeout)
+        for task in self.connections:
+            task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while not self.closing:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), self.keep_alive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                except HTTPError as e:
+                    writer.write(json_response(e.status, {'error': str(e)}, False))
+                    break
+                if request is None:
+                    break
+                self.busy.add(task)
+                try:
+                    keep_alive = await self.dispatch(request, writer) and not self.closing
+                finally:
+                    self.busy.discard(task)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # shutdown cancels idle connections, and busy ones that overrun
+            # shutdown_timeout; closing them is all there is left to do
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def dispatch(self, request, writer):
+        keep_alive = request.keep_alive
+        handler = self.routes.get(request.path)
+        try:
+            if handler is None:
+                raise HTTPError(HTTPStatus.NOT_FOUND)
+            if request.method not in ('GET', 'POST'):
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED)
+            return await handler(request, writer, keep_alive)
+        except HTTPError as e:
+            writer.write(json_response(e.status, {'error': str(e)}, keep_alive))
+            return keep_alive
+
+    def prompt(self, request):
+        prompt = request.params().get('prompt')
+        if not isinstance(prompt, str):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "missing 'prompt'")
+        return prompt
+
+    def seed(self, request):
+        # a JSON integer, or a string of digits in a query; not 1.5 or true
+        seed = request.params().get('seed')
+        if seed is None:
+            return None
+        if isinstance(seed, int) and not isinstance(seed, bool):
+            return seed
+        if request.method != 'POST' and re.fullmatch(r'-?[0-9]+', seed):
+            return int(seed)
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "'seed' must be an integer")
+
+    async def health(self, request, writer, keep_alive):
+        writer.write(json_response(HTTPStatus.OK, {'status': 'ok'}, keep_alive))
+        return keep_alive
+
+    async def metrics(self, request, writer, keep_alive):
+        if not self.model.metrics.enabled:
+            raise HTTPError(HTTPStatus.NOT_FOUND, 'metrics are not enabled')
+        body = self.model.metrics.export().encode('utf-8')
+        headers = {'Content-Type': 'text/plain; version=0.0.4', 'Content-Length': len(body)}
+        writer.write(response_head(HTTPStatus.OK, headers, keep_alive) + body)
+        return keep_alive
+
+    async def generate(self, request, writer, keep_alive):
+        prompt, seed = self.prompt(request), self.seed(request)
+        async with self.slots:
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(self.executor, self.model.AskAggmGPT1_5, prompt, seed)
+        writer.write(json_response(HTTPStatus.OK, {'prompt': prompt, 'response': response}, keep_alive))
+        return keep_alive
+
+    async def stream(self, request, writer, keep_alive):
+        prompt, seed = self.prompt(request), self.seed(request)
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        cancelled = threading.Event()
+
+        def produce():
+            # runs on the executor; a client that goes away stops generation
+            try:
+                for chunk in self.model.stream(prompt, seed):
+                    if cancelled.is_set():
+                        return
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            finally:
+                loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+        # HTTP/1.0 has no chunked encoding: the events are written as they
+        # are and closing the connection ends the response.
+        headers = {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'}
+        if request.version == 'HTTP/1.0':
+            keep_alive = False
+            frame = bytes
+            last = b''
+        else:
+            headers['Transfer-Encoding'] = 'chunked'
+            frame = http_chunk
+            last = http_chunk(b'')
+        async with self.slots:
+            writer.write(response_head(HTTPStatus.OK, headers, keep_alive))
+            done = loop.run_in_executor(self.executor, produce)
+            try:
+                while (chunk := await chunks.get()) is not None:
+                    writer.write(frame(sse_event({'text': chunk})))
+                    await writer.drain()
+                await done
+                writer.write(frame(sse_event({}, 'done')) + last)
+            except BaseException:
+                cancelled.set()
+                raise
+        return keep_alive
+
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache-size', type=int, default=0, help='cache up to this many prompts (default off)')
+    parser.add_argument('--cache-ttl', type=float, help='seconds a cached response stays valid')
+    parser.add_argument('--cache-variants', type=int, default=1,
+                        help='sampled responses to cache and rotate through for each unseeded prompt')
+
+
+def make_cache(args):
+    if not args.cache_size:
+        return None
+    return ResponseCache(args.cache_size, args.cache_ttl, args.cache_variants)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve AggmGPT-1.5 over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--snapshot', help='load the model from this snapshot, training and writing it if needed')
+    parser.add_argument('--concurrency', type=int, default=4, help='generations allowed to run at once')
+    parser.add_argument('--keep-alive-timeout', type=float, default=5.0)
+    parser.add_argument('--shutdown-timeout', type=float, default=30.0)
+    parser.add_argument('--metrics', action='store_true', help='record metrics and export them on /metrics')
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+    model = AggmGPT1_5(snapshot=args.snapshot, metrics=Metrics() if args.metrics else None, cache=make_cache(args))
+    server = Server(model, args.host, args.port, args.concurrency, args.keep_alive_timeout, args.shutdown_timeout)
+    print(f'Serving {model.ModelName} on http://{args.host}:{args.port}')
+    asyncio.run(server.serve_forever())
+
+
+if __name__ == '__main__':
+    main()
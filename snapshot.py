@@ -0,0 +1,538 @@
+import hashlib
+import io
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+from itertools import islice
+
+from ngram import UNKNOWN, NgramCounts, NgramModel, Successors, Vocabulary
+
+SNAPSHOT_MAGIC = b'AGGM'
+SNAPSHOT_VERSION = 4
+
+# Everything after the header is a run of 8-byte aligned sections:
+#   token_offsets u32[V+1], token_order u32[V], token_blob bytes,
+#   node_hash u64[N] (sorted), node_parent u32[N], node_token u32[N],
+#   node_offsets u32[N+1], successors u32[E], cumulative u32[E], tail u32[T]
+# A node is an n-gram context.  Its parent is the same context without its
+# oldest token, so contexts form a trie walked from the most recent token
+# backwards, and the hash of a node is derived from its parent's hash.
+#
+# Text added after training is appended as delta records, each a header and
+# the sections token_offsets u32[K+1], token_blob bytes, words u32[W].  The
+# words are the new tail, then every touched context with its added counts:
+#   T, tail..., then per context: n, context..., k, (next id, count) * k
+_HEADER = struct.Struct('<4sHHB3x32sIIIII')
+_DELTA_HEADER = struct.Struct('<4sIIIII')
+_DELTA_MAGIC = b'AGGD'
+_BYTEORDER = {'little': 1, 'big': 2}
+_NO_NODE = 0xFFFFFFFF
+_HASH_ROOT = 0xcbf29ce484222325
+_HASH_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def corpus_digest(text, settings=''):
+    # settings describe anything besides the corpus that shaped the tables,
+    # such as pruning options
+    return training_digest(hashlib.sha256(text.encode('utf-8')), settings)
+
+
+def training_digest(text_hash, settings=''):
+    # corpus_digest for text that was hashed as it streamed past; text_hash
+    # is a hashlib.sha256 of it and is left as it is
+    digest = text_hash.copy()
+    if settings:
+        digest.update(b'\0' + settings.encode('utf-8'))
+    return digest.digest()
+
+
+def context_hash(parent_hash, token_id):
+    h = ((parent_hash ^ (token_id + 1)) * 0x100000001b3) & _HASH_MASK
+    return h ^ (h >> 29)
+
+
+def _aligned(size):
+    return (size + 7) & ~7
+
+
+def _sections(vocab_size, node_count, entry_count, blob_size, tail_size):
+    return (
+        ('token_offsets', 'I', vocab_size + 1),
+        ('token_order', 'I', vocab_size),
+        ('token_blob', 'B', blob_size),
+        ('node_hash', 'Q', node_count),
+        ('node_parent', 'I', node_count),
+        ('node_token', 'I', node_count),
+        ('node_offsets', 'I', node_count + 1),
+        ('successors', 'I', entry_count),
+        ('cumulative', 'I', entry_count),
+        ('tail', 'I', tail_size),
+    )
+
+
+def _delta_sections(token_count, blob_size, word_count):
+    return (
+        ('token_offsets', 'I', token_count + 1),
+        ('token_blob', 'B', blob_size),
+        ('words', 'I', word_count),
+    )
+
+
+def _write_sections(f, sections, arrays):
+    for name, _, _ in sections:
+        data = bytes(arrays[name])
+        f.write(data)
+        f.write(b'\0' * (_aligned(len(data)) - len(data)))
+
+
+def _token_arrays(tokens):
+    tokens = [t.encode('utf-8') for t in tokens]
+    token_offsets = array('I', [0])
+    for t in tokens:
+        token_offsets.append(token_offsets[-1] + len(t))
+    return tokens, token_offsets
+
+
+def write_snapshot(path, model, training_corpus=None, settings=''):
+    # Without training_corpus the model's own digest is written: that of the
+    # snapshot it was read from, or of the text it was trained on.
+    if training_corpus is not None:
+        digest = corpus_digest(training_corpus, settings)
+    elif model.digest is not None:
+        digest = model.digest
+    else:
+        raise ValueError('the model does not know what it was trained on; pass training_corpus')
+    # context tuple -> [hash, successors].  Every suffix of a context is a
+    # trie node, with or without successors of its own.
+    nodes = {(): [_HASH_ROOT, ()]}
+    for context, found in model.contexts():
+        nodes[context] = [_HASH_ROOT, found]
+    for context in list(nodes):
+        while context and context[1:] not in nodes:
+            context = context[1:]
+            nodes[context] = [_HASH_ROOT, ()]
+    for context in sorted(nodes, key=len):
+        if context:
+            nodes[context][0] = context_hash(nodes[context[1:]][0], context[0])
+
+    max_order = model.max_order
+    tokens, token_offsets = _token_arrays(model.vocabulary.tokens)
+    ordered = sorted(nodes, key=lambda c: (nodes[c][0], len(c), c))
+    index = {c: i for i, c in enumerate(ordered)}
+    node_offsets = array('I', [0])
+    successors = array('I')
+    cumulative = array('I')
+    for c in ordered:
+        half = len(nodes[c][1]) // 2
+        successors.extend(nodes[c][1][:half])
+        cumulative.extend(nodes[c][1][half:])
+        node_offsets.append(len(successors))
+    arrays = {
+        'token_offsets': token_offsets,
+        'token_order': array('I', sorted(range(len(tokens)), key=tokens.__getitem__)),
+        'token_blob': b''.join(tokens),
+        'node_hash': array('Q', [nodes[c][0] for c in ordered]),
+        'node_parent': array('I', [_NO_NODE if not c else index[c[1:]] for c in ordered]),
+        'node_token': array('I', [_NO_NODE if not c else c[0] for c in ordered]),
+        'node_offsets': node_offsets,
+        'successors': successors,
+        'cumulative': cumulative,
+        'tail': array('I', model.tail),
+    }
+    header = _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, max_order, _BYTEORDER[sys.byteorder],
+                          digest, len(tokens), len(ordered), len(successors),
+                          token_offsets[-1], len(model.tail))
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        _write_sections(f, _sections(len(tokens), len(ordered), len(successors), token_offsets[-1],
+                                     len(model.tail)), arrays)
+    os.replace(tmp_path, path)
+
+
+def append_delta(path, vocab_size, tokens, counts, tail):
+    # Appends what NgramModel.update added to a snapshot: the tokens given
+    # ids vocab_size and up, the counts and the new tail.  Only the delta
+    # records are read back, to check the file holds the model being
+    # updated and to drop a record a crash left incomplete.
+    tokens, token_offsets = _token_arrays(tokens)
+    words = array('I', [len(tail)])
+    words.extend(tail)
+    for context, added in counts.counts.items():
+        words.append(len(context))
+        words.extend(context)
+        words.append(len(added))
+        for next_id, count in added.items():
+            words.append(next_id)
+            words.append(count)
+    sections = _delta_sections(len(tokens), token_offsets[-1], len(words))
+    arrays = {'token_offsets': token_offsets, 'token_blob': b''.join(tokens), 'words': words}
+    body = io.BytesIO()
+    _write_sections(body, sections, arrays)
+    body = body.getvalue()
+    with open(path, 'r+b') as f:
+        _, _, size, base_sections = _check_header(f.read(_HEADER.size), None)
+        base_end = _HEADER.size + sum(_aligned(count * struct.calcsize(code)) for _, code, count in base_sections)
+        if os.fstat(f.fileno()).st_size < base_end:
+            raise SnapshotError('truncated snapshot')
+        f.seek(base_end)
+        end = base_end
+        for delta, delta_end in _deltas(memoryview(f.read()), 0, size):
+            size += len(delta['token_offsets']) - 1
+            end = base_end + delta_end
+        if size != vocab_size:
+            raise SnapshotError('snapshot does not hold the model being updated')
+        f.seek(end)
+        f.truncate()
+        f.write(_DELTA_HEADER.pack(_DELTA_MAGIC, vocab_size, len(tokens), token_offsets[-1], len(words),
+                                   zlib.crc32(body)))
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _check_header(buffer, training_corpus, settings=''):
+    if len(buffer) < _HEADER.size:
+        raise SnapshotError('truncated snapshot')
+    magic, version, max_order, byteorder, digest, vocab_size, node_count, entry_count, blob_size, tail_size = \
+        _HEADER.unpack_from(buffer)
+    if magic != SNAPSHOT_MAGIC:
+        raise SnapshotError('not an AggmGPT snapshot')
+    if version != SNAPSHOT_VERSION:
+        raise SnapshotError(f'unsupported snapshot version {version}')
+    if byteorder != _BYTEORDER[sys.byteorder]:
+        raise SnapshotError('snapshot was written on a machine with a different byte order')
+    if training_corpus is not None and digest != corpus_digest(training_corpus, settings):
+        raise SnapshotError('snapshot is stale: corpus or training settings have changed since it was written')
+    return max_order, digest, vocab_size, _sections(vocab_size, node_count, entry_count, blob_size, tail_size)
+
+
+def _parse(buffer, training_corpus, settings=''):
+    max_order, digest, vocab_size, sections = _check_header(buffer, training_corpus, settings)
+    view = memoryview(buffer)
+    parsed = {'max_order': max_order, 'digest': digest}
+    offset = _read_sections(view, _HEADER.size, sections, parsed)
+    parsed['deltas'] = [delta for delta, _ in _deltas(view, offset, vocab_size)]
+    return parsed
+
+
+def _deltas(view, offset, vocab_size):
+    # The delta records from offset on, each with the offset it ends at.  A
+    # crash while appending can leave an incomplete or garbled record at the
+    # end; it and whatever follows are ignored, and append_delta overwrites
+    # them.
+    while offset + _DELTA_HEADER.size <= len(view):
+        magic, delta_vocab_size, token_count, blob_size, word_count, crc = _DELTA_HEADER.unpack_from(view, offset)
+        if magic != _DELTA_MAGIC:
+            return
+        delta = {}
+        start = offset + _DELTA_HEADER.size
+        try:
+            end = _read_sections(view, start, _delta_sections(token_count, blob_size, word_count), delta)
+        except SnapshotError:
+            end = None
+        if end is None or zlib.crc32(view[start:end]) != crc:
+            _release(delta)
+            return
+        if delta_vocab_size != vocab_size:
+            _release(delta)
+            raise SnapshotError('snapshot delta does not follow the model before it')
+        yield delta, end
+        vocab_size += token_count
+        offset = end
+
+
+def _release(sections):
+    for section in sections.values():
+        section.release()
+
+
+def _read_sections(view, offset, sections, parsed):
+    for name, code, count in sections:
+        size = count * struct.calcsize(code)
+        if offset + size > len(view):
+            raise SnapshotError('truncated snapshot')
+        parsed[name] = view[offset:offset + size].cast(code)
+        offset += _aligned(size)
+    return offset
+
+
+def _tokens(parsed):
+    blob = bytes(parsed['token_blob'])
+    offsets = parsed['token_offsets']
+    return [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def _delta_counts(delta, max_order):
+    # the words of a delta record back as counts, with the tail as carry
+    words = delta['words'].tolist()
+    counts = NgramCounts(max_order=max_order)
+    i = words[0] + 1
+    counts.carry = words[1:i]
+    while i < len(words):
+        n = words[i]
+        context = tuple(words[i + 1:i + 1 + n])
+        i += n + 1
+        k = words[i]
+        counts.counts[context] = dict(zip(words[i + 1:i + 1 + 2 * k:2], words[i + 2:i + 2 + 2 * k:2]))
+        i += 2 * k + 1
+    return counts
+
+
+def read_snapshot(path, training_corpus, settings=''):
+    with open(path, 'rb') as f:
+        parsed = _parse(f.read(), training_corpus, settings)
+    vocabulary = Vocabulary(_tokens(parsed))
+    parents = parsed['node_parent'].tolist()
+    tokens = parsed['node_token'].tolist()
+    node_offsets = parsed['node_offsets'].tolist()
+    successors = parsed['successors'].tolist()
+    cumulative = parsed['cumulative'].tolist()
+    nodes = []
+    for i in range(len(parents)):
+        start, end = node_offsets[i], node_offsets[i + 1]
+        nodes.append(Successors(successors[start:end] + cumulative[start:end]) if start != end else None)
+    edges = {}
+    root = 0
+    for i, parent in enumerate(parents):
+        if parent == _NO_NODE:
+            root = i
+        else:
+            edges[parent << 32 | tokens[i]] = i
+    model = NgramModel(vocabulary, parsed['max_order'], edges, nodes, root, parsed['tail'].tolist())
+    model.digest = parsed['digest']
+    for delta in parsed['deltas']:
+        for token in _tokens(delta):
+            vocabulary.add(token)
+        model.update(_delta_counts(delta, model.max_order))
+    return model
+
+
+class _SortedTokens:
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return len(self.snapshot.token_order)
+
+    def __getitem__(self, i):
+        return self.snapshot.token_bytes(self.snapshot.token_order[i])
+
+
+class _MappedVocabulary:
+    # Tokens added after the snapshot was written live in memory after the
+    # mapped ones.
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self._sorted_tokens = _SortedTokens(snapshot)
+        self.base_size = len(snapshot.token_order)
+        self.added = []
+        self.added_ids = {}
+
+    def __len__(self):
+        return self.base_size + len(self.added)
+
+    def token_id(self, word):
+        encoded = word.encode('utf-8')
+        i = bisect_left(self._sorted_tokens, encoded)
+        if i < len(self._sorted_tokens) and self._sorted_tokens[i] == encoded:
+            return self.snapshot.token_order[i]
+        return self.added_ids.get(word, UNKNOWN)
+
+    def add(self, token):
+        token_id = self.token_id(token)
+        if token_id == UNKNOWN:
+            token_id = len(self)
+            self.added.append(token)
+            self.added_ids[token] = token_id
+        return token_id
+
+    def encode(self, words):
+        return [self.token_id(word) for word in words]
+
+    def token(self, token_id):
+        if token_id >= self.base_size:
+            return self.added[token_id - self.base_size]
+        return self.snapshot.token_bytes(token_id).decode('utf-8')
+
+    def decode(self, ids):
+        return [self.token(i) for i in ids]
+
+    @property
+    def tokens(self):
+        return self.decode(range(len(self)))
+
+
+class MappedNgramModel:
+    # Counts added after the snapshot was written, by update() or by delta
+    # records in the file, go into overlay: context tuple -> Successors,
+    # checked before the mapped tables.  As in NgramModel, version is odd
+    # while update() writes, and lookups that overlap a write are retried.
+    def __init__(self, path, training_corpus, settings=''):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        parsed = _parse(self._mmap, training_corpus, settings)
+        self.max_order = parsed['max_order']
+        self.digest = parsed['digest']
+        self.token_offsets = parsed['token_offsets']
+        self.token_order = parsed['token_order']
+        self.token_blob = parsed['token_blob']
+        self.node_hash = parsed['node_hash']
+        self.node_parent = parsed['node_parent']
+        self.node_token = parsed['node_token']
+        self.node_offsets = parsed['node_offsets']
+        self.successor_ids = parsed['successors']
+        self.cumulative = parsed['cumulative']
+        self.vocabulary = _MappedVocabulary(self)
+        self.root = self._child(_NO_NODE, _HASH_ROOT, _NO_NODE)
+        self.tail = parsed['tail'].tolist()
+        self.overlay = {}
+        self.version = 0
+        parsed['tail'].release()
+        for delta in parsed['deltas']:
+            for token in _tokens(delta):
+                self.vocabulary.add(token)
+            self.update(_delta_counts(delta, self.max_order))
+            _release(delta)
+
+    def update(self, counts):
+        # NgramModel.update for tables that cannot change in place: the
+        # merged successors of touched contexts go into the overlay.
+        overlay = self.overlay
+        changes = []
+        for context, added in counts.counts.items():
+            current = overlay.get(context)
+            if current is None:
+                current = self._lookup(context)
+            changes.append((context, Successors.from_counts(added) if current is None else current.merge(added)))
+        self.version += 1
+        try:
+            overlay.update(changes)
+            self.tail = list(counts.carry)
+        finally:
+            self.version += 1
+
+    def contexts(self):
+        # every context with successors, mapped or added, for write_snapshot
+        overlay = self.overlay
+        contexts = {}
+
+        def context(node):
+            if node not in contexts:
+                parent = self.node_parent[node]
+                contexts[node] = () if parent == _NO_NODE else (self.node_token[node],) + context(parent)
+            return contexts[node]
+
+        for node in range(len(self.node_hash)):
+            c = context(node)
+            found = overlay.get(c)
+            if found is None:
+                found = self._successors(node)
+            if found is not None:
+                yield c, found
+        mapped = set(contexts.values())
+        for c, found in list(overlay.items()):
+            if c not in mapped:
+                yield c, found
+
+    def token_bytes(self, token_id):
+        return self.token_blob[self.token_offsets[token_id]:self.token_offsets[token_id + 1]].tobytes()
+
+    def _child(self, parent, h, token_id):
+        i = bisect_left(self.node_hash, h)
+        while i < len(self.node_hash) and self.node_hash[i] == h:
+            if self.node_parent[i] == parent and self.node_token[i] == token_id:
+                return i
+            i += 1
+        return _NO_NODE
+
+    def find(self, context):
+        node, h = self.root, _HASH_ROOT
+        for token_id in reversed(context):
+            if node == _NO_NODE or token_id == UNKNOWN:
+                return _NO_NODE
+            h = context_hash(h, token_id)
+            node = self._child(node, h, token_id)
+        return node
+
+    def _successors(self, node):
+        start, end = self.node_offsets[node], self.node_offsets[node + 1]
+        if start == end:
+            return None
+        return Successors.from_arrays(self.successor_ids[start:end], self.cumulative[start:end])
+
+    def _lookup(self, context):
+        node = self.find(context)
+        return None if node == _NO_NODE else self._successors(node)
+
+    def lookup(self, context):
+        while True:
+            version = self.version
+            found = self.overlay.get(tuple(context))
+            if found is None:
+                found = self._lookup(context)
+            if version == self.version and not version & 1:
+                return found
+            time.sleep(0)
+
+    def longest_match(self, context, max_depth):
+        # The mapped tables never change, so without an overlay there is
+        # nothing an update could be halfway through.
+        overlay = self.overlay
+        if overlay:
+            while True:
+                version = self.version
+                match = self._overlay_match(context, max_depth, overlay)
+                if version == self.version and not version & 1:
+                    return match
+                time.sleep(0)
+        node, h = self.root, _HASH_ROOT
+        depth, best = 0, node
+        for d, token_id in enumerate(islice(reversed(context), max_depth), 1):
+            if token_id == UNKNOWN:
+                break
+            h = context_hash(h, token_id)
+            node = self._child(node, h, token_id)
+            if node == _NO_NODE:
+                break
+            if self.node_offsets[node] != self.node_offsets[node + 1]:
+                depth, best = d, node
+        return depth, self._successors(best)
+
+    def _overlay_match(self, context, max_depth, overlay):
+        # Every suffix of an overlay context is in the overlay too, so the
+        # walk goes on while either the mapped trie or the overlay has the
+        # context.
+        recent = list(islice(reversed(context), max_depth))
+        node, h = self.root, _HASH_ROOT
+        found = overlay.get(())
+        depth, best = 0, self._successors(node) if found is None else found
+        for d, token_id in enumerate(recent, 1):
+            if token_id == UNKNOWN:
+                break
+            if node != _NO_NODE:
+                h = context_hash(h, token_id)
+                node = self._child(node, h, token_id)
+            found = overlay.get(tuple(reversed(recent[:d])))
+            if found is None:
+                if node == _NO_NODE:
+                    break
+                found = self._successors(node)
+            if found is not None:
+                depth, best = d, found
+        return depth, best
+
+    def close(self):
+        for name in ('token_offsets', 'token_order', 'token_blob', 'node_hash', 'node_parent',
+                     'node_token', 'node_offsets', 'successor_ids', 'cumulative'):
+            getattr(self, name).release()
+        self._mmap.close()
@@ -0,0 +1,18 @@
+import contextlib
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AggmGPT1_5 import AggmGPT1_5  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def trained():
+    # one training run shared by every test; tests that change the model
+    # build their own from these tables
+    with contextlib.redirect_stdout(io.StringIO()):
+        return AggmGPT1_5()
@@ -0,0 +1,137 @@
+import pytest
+
+from AggmGPT1_5 import AggmGPT1_5
+from cache import ResponseCache
+from ngram import NgramModel, Vocabulary
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_least_recently_used_is_evicted():
+    cache = ResponseCache(maxsize=2)
+    cache.store('a', 'A')
+    cache.store('b', 'B')
+    assert cache.lookup('a') == 'A'
+    cache.store('c', 'C')
+    assert list(cache.entries) == ['a', 'c']
+    assert cache.lookup('b') is None
+    cache.store('d', 'D')
+    assert list(cache.entries) == ['c', 'd']
+    assert cache.stats()['evictions'] == 2
+
+
+def test_entries_expire_ttl_after_first_store():
+    clock = FakeClock()
+    cache = ResponseCache(ttl=10, variants=2, clock=clock)
+    cache.store('a', 'A1')
+    clock.now = 5
+    cache.store('a', 'A2')
+    assert cache.lookup('a') == 'A1'
+    clock.now = 9.9
+    assert cache.lookup('a') == 'A2'
+    clock.now = 10
+    assert cache.lookup('a') is None
+    assert len(cache) == 0
+    assert cache.stats()['expirations'] == 1
+
+
+def test_no_ttl_never_expires():
+    clock = FakeClock()
+    cache = ResponseCache(clock=clock)
+    cache.store('a', 'A')
+    clock.now = 1e12
+    assert cache.lookup('a') == 'A'
+
+
+def test_unseeded_keys_collect_variants_then_rotate():
+    cache = ResponseCache(variants=3)
+    answers = []
+    for i in range(8):
+        response = cache.lookup('a')
+        if response is None:
+            response = f'A{i}'
+            cache.store('a', response)
+        answers.append(response)
+    assert answers == ['A0', 'A1', 'A2', 'A0', 'A1', 'A2', 'A0', 'A1']
+    cache.store('a', 'extra')
+    assert cache.entries['a'].responses == ['A0', 'A1', 'A2']
+
+
+def test_deterministic_keys_need_one_response():
+    cache = ResponseCache(variants=3)
+    cache.store('seeded', 'S', deterministic=True)
+    assert cache.lookup('seeded', deterministic=True) == 'S'
+    assert cache.lookup('seeded', deterministic=True) == 'S'
+    cache.store('seeded', 'other', deterministic=True)
+    assert cache.entries['seeded'].responses == ['S']
+    # an unseeded lookup of the same key still wants its variants
+    assert cache.lookup('seeded') is None
+
+
+def test_stats():
+    cache = ResponseCache(maxsize=1)
+    assert cache.stats() == {'size': 0, 'hits': 0, 'misses': 0, 'hit_rate': 0.0, 'evictions': 0,
+                             'expirations': 0}
+    cache.lookup('a')
+    cache.store('a', 'A')
+    cache.lookup('a')
+    cache.lookup('a')
+    cache.store('b', 'B')
+    assert cache.stats() == {'size': 1, 'hits': 2, 'misses': 1, 'hit_rate': 2 / 3, 'evictions': 1,
+                             'expirations': 0}
+
+
+@pytest.mark.parametrize('options', [{'maxsize': 0}, {'variants': 0}])
+def test_options_are_checked(options):
+    with pytest.raises(ValueError):
+        ResponseCache(**options)
+
+
+def test_model_caches_seeded_answers(trained):
+    cache = ResponseCache()
+    model = AggmGPT1_5(ngram_models=trained.ngram_models, cache=cache)
+    first = model.AskAggmGPT1_5('Hi', 3)
+    assert model.AskAggmGPT1_5('  hi ', 3) == first
+    assert len(cache) == 1
+    assert (cache.stats()['misses'], cache.stats()['hits']) == (1, 1)
+
+
+def fresh(trained, cache):
+    models = trained.ngram_models
+    return AggmGPT1_5(ngram_models=NgramModel(Vocabulary(models.vocabulary.tokens), models.max_order,
+                                              dict(models.edges), list(models.successors), models.root,
+                                              models.tail), cache=cache)
+
+
+def test_add_documents_clears_the_cache(trained):
+    cache = ResponseCache()
+    model = fresh(trained, cache)
+    model.AskAggmGPT1_5('hi', 3)
+    assert len(cache) == 1
+    model.add_documents(['user: hi\nai: zorblax'])
+    assert len(cache) == 0
+
+
+def test_answers_from_old_tables_are_not_served(trained):
+    # a request that generates from the old tables and stores its answer
+    # after add_documents has cleared the cache
+    cache = ResponseCache()
+    model = fresh(trained, cache)
+    answer = model.answer
+
+    def slow_answer(input_text, seed=None):
+        response = answer(input_text, seed)
+        model.add_documents(['user: hi\nai: zorblax'])
+        return response
+
+    model.answer = slow_answer
+    model.AskAggmGPT1_5('hi', 3)
+    model.answer = answer
+    model.AskAggmGPT1_5('hi', 3)
+    assert (cache.stats()['misses'], cache.stats()['hits']) == (2, 0)
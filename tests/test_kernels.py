@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+from AggmGPT1_5 import AggmGPT1_5, GenerationState
+from ngram import NgramModel
+
+np = pytest.importorskip('numpy')
+
+SHAPES = [(1, 3), (2, 3), (7, 3), (30, 3), (5, 4), (12, 8)]
+
+
+@pytest.fixture(scope='module')
+def backends():
+    return (AggmGPT1_5(ngram_models=NgramModel(), backend='python'),
+            AggmGPT1_5(ngram_models=NgramModel(), backend='numpy'))
+
+
+def matrix(rows, cols, rng):
+    return [[rng.uniform(-3, 3) for _ in range(cols)] for _ in range(rows)]
+
+
+def assert_close(expected, actual):
+    expected, actual = np.asarray(expected, dtype=float), np.asarray(actual, dtype=float)
+    assert expected.shape == actual.shape
+    np.testing.assert_allclose(actual, expected, rtol=1e-9, atol=1e-12)
+
+
+def kernel_calls(seq_len, d_model, rng):
+    X, W = matrix(seq_len, d_model, rng), matrix(d_model, 5, rng)
+    Q, K, V = (matrix(seq_len, d_model, rng) for _ in range(3))
+    scores = [rng.uniform(-50, 50) for _ in range(seq_len)]
+    calls = {
+        'mat_mul': lambda m: m.mat_mul(X, W),
+        'softmax': lambda m: m.softmax(scores),
+        'softmax_rows': lambda m: m.softmax_rows(X),
+        'self_attention': lambda m: m.self_attention(Q, K, V),
+        'positional_encoding': lambda m: m.positional_encoding(seq_len, d_model),
+        'add_positional_encoding': lambda m: m.add_positional_encoding(X, m.positional_encoding(seq_len, d_model)),
+        'feed_forward_network': lambda m: m.feed_forward_network(X),
+    }
+    for heads in {1, max(1, d_model // 2), d_model}:
+        calls[f'multi_head_attention[{heads}]'] = lambda m, heads=heads: m.multi_head_attention(Q, K, V, heads)
+    return calls
+
+
+@pytest.mark.parametrize('seq_len, d_model', SHAPES)
+def test_kernels_match(backends, seq_len, d_model):
+    python, numpy = backends
+    for name, call in kernel_calls(seq_len, d_model, random.Random(seq_len * 31 + d_model)).items():
+        assert_close(call(python), call(numpy))
+
+
+def test_softmax_of_nothing(backends):
+    python, numpy = backends
+    assert list(numpy.softmax([])) == python.softmax([]) == []
+
+
+@pytest.mark.parametrize('length', [1, 3, 26, 40])
+def test_attention_pipeline_matches(backends, length):
+    python, numpy = backends
+    tokens = [f'word{i % 7}' for i in range(length)]
+    assert_close(python.attention_pipeline(tokens, random.Random(length)),
+                 numpy.attention_pipeline(tokens, random.Random(length)))
+
+
+def test_incremental_attention_matches(backends):
+    python, numpy = backends
+    states = [GenerationState([], [], 4, embedding_rng=random.Random(5)) for _ in backends]
+    for i in range(40):
+        outputs = []
+        for model, state in zip(backends, states):
+            state.push(f'word{i % 9}', i % 9)
+            outputs.append(model.incremental_attention(state))
+        assert_close(*outputs)
@@ -0,0 +1,23 @@
+import random
+
+import pytest
+
+from AggmGPT1_5 import AggmGPT1_5
+from metrics import Metrics
+from pruning import default_prompts
+
+
+@pytest.mark.parametrize('attention', ['off', 'incremental'])
+def test_batch_records_what_sequential_generation_does(trained, attention):
+    prompts = default_prompts(20) * 2
+    batch_metrics, sequential_metrics = Metrics(), Metrics()
+    batch = AggmGPT1_5(ngram_models=trained.ngram_models, attention=attention, metrics=batch_metrics)
+    sequential = AggmGPT1_5(ngram_models=trained.ngram_models, attention=attention, metrics=sequential_metrics)
+    answers = batch.AskAggmGPT1_5_batch(prompts, 7)
+    base = random.Random(7)
+    assert answers == [sequential.AskAggmGPT1_5(prompt, random.Random(base.getrandbits(64))) for prompt in prompts]
+    assert batch_metrics.counters == sequential_metrics.counters
+    assert batch_metrics.counter('requests_total') == len(prompts)
+    for name, labels in (('request_seconds', {}), ('stage_seconds', {'stage': 'lookup'}),
+                         ('stage_seconds', {'stage': 'attention'})):
+        assert batch_metrics.histogram(name, **labels)[0] == sequential_metrics.histogram(name, **labels)[0]
@@ -0,0 +1,139 @@
+import contextlib
+import io
+import os
+import threading
+
+import pytest
+
+from AggmGPT1_5 import END_OF_TEXT, AggmGPT1_5
+from data import corpus
+from ngram import NgramModel, Vocabulary
+from snapshot import SnapshotError, read_snapshot
+
+DOCUMENTS = [
+    'user: what is a zorblax?\nai: A zorblax is a brand new word, friend.',
+    'user: hello there\nai: Hi! How can I help you today?',
+    '',
+    'just some words without dialogue',
+]
+
+
+def quiet(call, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return call(*args, **kwargs)
+
+
+@pytest.fixture(scope='module')
+def retrained(trained):
+    return quiet(trained.train_model, corpus + ''.join(f'\n{d}\n{END_OF_TEXT}\n' for d in DOCUMENTS))
+
+
+def fresh(trained):
+    # a private copy of the trained tables to update
+    models = trained.ngram_models
+    copy = NgramModel(Vocabulary(models.vocabulary.tokens), models.max_order, dict(models.edges),
+                      list(models.successors), models.root, models.tail)
+    copy.digest = models.digest
+    return AggmGPT1_5(ngram_models=copy)
+
+
+def test_add_documents_equals_retraining(trained, retrained):
+    model = fresh(trained)
+    model.add_documents(DOCUMENTS[:2])
+    model.add_documents(DOCUMENTS[2:])
+    assert model.ngram_models == retrained
+    assert model.ngram_models.tail == retrained.tail
+
+
+def test_training_paths_agree_on_tail(trained):
+    documents = corpus.split(END_OF_TEXT)
+    streamed = quiet(trained.train_documents, documents, 100)
+    parallel = quiet(trained.train_parallel, documents, 1, 7)
+    assert streamed.tail == parallel.tail == trained.ngram_models.tail
+
+
+@pytest.mark.parametrize('mapped', [False, True])
+def test_snapshot_deltas(tmp_path, trained, retrained, mapped):
+    path = str(tmp_path / 'model.aggm')
+    model = fresh(trained)
+    model.save(path)
+    model.add_documents(DOCUMENTS[:2], snapshot=path)
+    model.add_documents(DOCUMENTS[2:], snapshot=path)
+    loaded = AggmGPT1_5.load(path, mapped=mapped)
+    for context, successors in retrained.contexts():
+        assert loaded.ngram_models.lookup(context) == successors
+    assert loaded.ngram_models.tail == retrained.tail
+    # a mapped model folds its deltas into a fresh snapshot
+    loaded.save(path)
+    assert read_snapshot(path, corpus) == retrained
+    if mapped:
+        loaded.ngram_models.close()
+
+
+def test_mapped_update_matches_heap_update(tmp_path, trained, retrained):
+    path = str(tmp_path / 'model.aggm')
+    trained.save(path)
+    mapped = AggmGPT1_5.load(path, mapped=True)
+    mapped.add_documents(DOCUMENTS)
+    models = mapped.ngram_models
+    ids = retrained.vocabulary.encode(trained.tokenize(corpus.lower()))[-2000:]
+    for i in range(len(ids)):
+        assert models.longest_match(ids[:i], 4) == retrained.longest_match(ids[:i], 4)
+    models.close()
+
+
+def test_torn_delta_is_ignored_and_overwritten(tmp_path, trained, retrained):
+    path = str(tmp_path / 'model.aggm')
+    model = fresh(trained)
+    model.save(path)
+    model.add_documents(DOCUMENTS[:2], snapshot=path)
+    complete = os.path.getsize(path)
+    model.add_documents(DOCUMENTS[2:], snapshot=path)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+    partial = read_snapshot(path, corpus)
+    assert len(partial.vocabulary) < len(retrained.vocabulary)
+    # the next append replaces the torn record
+    again = fresh(trained)
+    again.add_documents(DOCUMENTS[:2])
+    again.add_documents(DOCUMENTS[2:], snapshot=path)
+    assert read_snapshot(path, corpus) == retrained
+    assert os.path.getsize(path) > complete
+
+
+def test_delta_for_another_model_is_rejected(tmp_path, trained):
+    path = str(tmp_path / 'model.aggm')
+    trained.save(path)
+    model = fresh(trained)
+    model.add_documents(['user: brandnewword'])
+    with pytest.raises(SnapshotError):
+        model.add_documents(['user: anothernewword'], snapshot=path)
+
+
+def test_readers_see_whole_updates(trained):
+    model = fresh(trained)
+    models = model.ngram_models
+    words = ['user:', 'zorblax', 'zorblax']
+
+    def match():
+        return models.longest_match(models.vocabulary.encode(words), 4)
+
+    # the word is known before reading starts, so a reader cannot encode it
+    # as unknown and then look it up in tables that know it
+    model.add_documents(['user: zorblax'])
+    published = [match()]
+    stop = threading.Event()
+    seen = []
+
+    def read():
+        while not stop.is_set():
+            seen.append(match())
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    for _ in range(30):
+        model.add_documents(['user: zorblax zorblax zorblax'])
+        published.append(match())
+    stop.set()
+    reader.join()
+    assert seen and all(found in published for found in seen)
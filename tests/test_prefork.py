@@ -0,0 +1,67 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='prefork needs fork()')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def children(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def wait_until(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/task'), reason='needs /proc to find the workers')
+def test_workers_exit_when_parent_is_killed():
+    port = free_port()
+    parent = subprocess.Popen([sys.executable, os.path.join(ROOT, 'prefork.py'), '--workers', '2', '--port', str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    workers = []
+    try:
+        def serving():
+            try:
+                return urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=1).status == 200
+            except OSError:
+                return False
+
+        assert wait_until(serving, 60)
+        assert wait_until(lambda: len(children(parent.pid)) == 2, 10)
+        workers = children(parent.pid)
+        parent.send_signal(signal.SIGKILL)
+        parent.wait()
+        assert wait_until(lambda: not any(alive(pid) for pid in workers), 10)
+    finally:
+        parent.kill()
+        for pid in workers:
+            if alive(pid):
+                os.kill(pid, signal.SIGKILL)
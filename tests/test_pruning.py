@@ -0,0 +1,100 @@
+import contextlib
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+
+from AggmGPT1_5 import AggmGPT1_5
+from metrics import Metrics
+from data import corpus
+from pruning import Pruning, default_prompts
+from snapshot import SnapshotError, read_snapshot, write_snapshot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def dead_ends(models, prompts):
+    metrics = Metrics()
+    model = AggmGPT1_5(ngram_models=models, metrics=metrics)
+    for i, prompt in enumerate(prompts):
+        model.AskAggmGPT1_5(prompt, i)
+    return metrics.counter('stops_total', reason='no_match')
+
+
+@pytest.mark.parametrize('options', [
+    {'threshold': 1e-3},
+    {'threshold': 1e-2},
+    {'min_count': 2},
+    {'min_count': {1: 3, 2: 5}},
+    {'top_k': 1},
+    {'min_count': 3, 'top_k': 2, 'threshold': 1e-4},
+])
+def test_pruning_never_dead_ends(trained, options):
+    prompts = default_prompts(50)
+    assert dead_ends(trained.ngram_models, prompts) == 0
+    assert dead_ends(Pruning(**options).prune_model(trained.ngram_models), prompts) == 0
+
+
+def test_one_word_contexts_are_kept(trained):
+    pruned = Pruning(min_count=10 ** 9, threshold=1.0).prune_model(trained.ngram_models)
+    original = {context for context, _ in trained.ngram_models.contexts() if len(context) <= 1}
+    assert original == {context for context, _ in pruned.contexts()}
+
+
+def test_training_time_pruning_matches_offline_pass(trained):
+    pruning = Pruning(min_count={4: 2, 5: 2}, top_k=8, threshold=1e-5)
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = AggmGPT1_5(pruning=pruning)
+    assert model.ngram_models == pruning.prune_model(trained.ngram_models)
+
+
+def test_snapshot_records_pruning(tmp_path):
+    path = str(tmp_path / 'model.aggm')
+    pruning = Pruning(min_count=2)
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        unpruned = AggmGPT1_5(snapshot=path)
+        pruned = AggmGPT1_5(snapshot=path, pruning=pruning)
+        assert 'stale' in output.getvalue()
+        assert pruned.ngram_models != unpruned.ngram_models
+        assert AggmGPT1_5(snapshot=path, pruning=Pruning(min_count=2)).ngram_models == pruned.ngram_models
+        assert AggmGPT1_5.load(path, pruning=Pruning(min_count=2)).ngram_models == pruned.ngram_models
+        assert AggmGPT1_5(snapshot=path).ngram_models == unpruned.ngram_models
+
+
+def test_top_k_must_keep_something():
+    with pytest.raises(ValueError):
+        Pruning(top_k={3: 0})
+
+
+@pytest.mark.parametrize('first', [{'top_k': 1}, {'min_count': 3}])
+def test_pruning_a_pruned_model(trained, first):
+    once = Pruning(**first).prune_model(trained.ngram_models)
+    twice = Pruning(threshold=1e-4).prune_model(once)
+    assert 0 < sum(1 for _ in twice.contexts()) <= sum(1 for _ in once.contexts())
+    assert dead_ends(twice, default_prompts(50)) == 0
+
+
+def test_cli_prunes_its_own_output(trained, tmp_path):
+    pruning = Pruning(top_k=1)
+    pruned = str(tmp_path / 'pruned.aggm')
+    write_snapshot(pruned, pruning.prune_model(trained.ngram_models), corpus, pruning.settings())
+    twice = str(tmp_path / 'twice.aggm')
+    command = [sys.executable, os.path.join(ROOT, 'pruning.py'), pruned, twice, '--threshold', '1e-4',
+               '--prompts', '2', '--seeds', '1']
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    assert read_snapshot(twice, None) == Pruning(threshold=1e-4).prune_model(read_snapshot(pruned, None))
+    # it is not what training with either option would give
+    for options in ({'threshold': 1e-4}, {'top_k': 1}):
+        with pytest.raises(SnapshotError):
+            AggmGPT1_5.load(twice, pruning=Pruning(**options))
+
+
+def test_cli_reports_unreadable_snapshots(tmp_path):
+    path = tmp_path / 'junk.aggm'
+    path.write_bytes(b'junk')
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'pruning.py'), str(path)], capture_output=True,
+                            text=True)
+    assert result.returncode == 2
+    assert 'cannot read' in result.stderr and 'Traceback' not in result.stderr
@@ -0,0 +1,49 @@
+import random
+
+import pytest
+
+from AggmGPT1_5 import AggmGPT1_5
+from cache import ResponseCache
+
+SEEDS = [None, 7, random.Random(7), random.SystemRandom(), random]
+
+
+@pytest.fixture(params=['off', 'full', 'incremental'])
+def model(request, trained):
+    return AggmGPT1_5(ngram_models=trained.ngram_models, attention=request.param)
+
+
+@pytest.mark.parametrize('seed', SEEDS, ids=['none', 'int', 'random', 'system', 'module'])
+def test_entry_points_accept_seed(model, seed):
+    assert isinstance(model.predict_next_word('hello', model.ngram_models, seed), str)
+    assert isinstance(model.predict_next_word_with_attention('hello', seed), str)
+    assert isinstance(model.predict_sentence_with_attention('user: hi\nai:', 20, seed), str)
+    assert isinstance(model.AskAggmGPT1_5('hi', seed), str)
+    assert all(isinstance(answer, str) for answer in model.AskAggmGPT1_5_batch(['hi', 'hello'], seed))
+    assert isinstance(''.join(model.stream('hi', seed)), str)
+    assert isinstance(''.join(model.generate_tokens('user: hi\nai:', 20, seed)), str)
+    state = model.start_generation('hi', seed)
+    model.generate_next_id(state)
+
+
+@pytest.mark.parametrize('seed', [None, 7, random.SystemRandom()], ids=['none', 'int', 'system'])
+def test_session_accepts_seed(model, seed):
+    session = model.session(seed)
+    assert isinstance(session.ask('hi'), str)
+    assert isinstance(''.join(session.stream('hi')), str)
+
+
+def test_seeded_answers_repeat(model):
+    assert model.AskAggmGPT1_5('hi', 3) == model.AskAggmGPT1_5('hi', 3)
+    assert model.AskAggmGPT1_5('hi', random.Random(3)) == model.AskAggmGPT1_5('hi', 3)
+    assert ''.join(model.stream('hi', 3)) == model.AskAggmGPT1_5('hi', 3)
+    assert model.AskAggmGPT1_5_batch(['hi', 'hello'], 3) == model.AskAggmGPT1_5_batch(['hi', 'hello'], 3)
+
+
+def test_cache_treats_random_module_as_unseeded(trained):
+    cache = ResponseCache(variants=3)
+    model = AggmGPT1_5(ngram_models=trained.ngram_models, cache=cache)
+    for seed in [random] * 5 + [None] * 5:
+        model.AskAggmGPT1_5('hi', seed)
+    assert [key[2] for key in cache.entries] == [None]
+    assert (cache.stats()['misses'], cache.stats()['hits']) == (3, 7)
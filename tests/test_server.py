@@ -0,0 +1,87 @@
+import asyncio
+import json
+
+import pytest
+
+from AggmGPT1_5 import AggmGPT1_5
+from server import Server
+
+
+async def exchange(server, raw):
+    reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+    writer.write(raw)
+    await writer.drain()
+    # every request here ends with the server closing the connection
+    response = await asyncio.wait_for(reader.read(), 10)
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return head.decode('latin-1').split('\r\n'), body
+
+
+def run(trained, requests):
+    async def main():
+        server = Server(AggmGPT1_5(ngram_models=trained.ngram_models), port=0)
+        await server.start()
+        server.port = server.server.sockets[0].getsockname()[1]
+        try:
+            return [await exchange(server, raw) for raw in requests]
+        finally:
+            await server.shutdown()
+    return asyncio.run(main())
+
+
+def post(path, payload, version='HTTP/1.1'):
+    body = json.dumps(payload).encode('utf-8')
+    return (f'POST {path} {version}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n').encode() + body
+
+
+@pytest.mark.parametrize('seed', [1.5, True, '7', [7], 7.0])
+def test_seed_must_be_an_integer(trained, seed):
+    [(head, body)] = run(trained, [post('/generate', {'prompt': 'hi', 'seed': seed})])
+    assert head[0] == 'HTTP/1.1 400 Bad Request'
+    assert json.loads(body) == {'error': "'seed' must be an integer"}
+
+
+def test_integer_seeds_are_accepted(trained):
+    get = b'GET /generate?prompt=hi&seed=-7 HTTP/1.1\r\nConnection: close\r\n\r\n'
+    bad_get = b'GET /generate?prompt=hi&seed=1.5 HTTP/1.1\r\nConnection: close\r\n\r\n'
+    responses = run(trained, [post('/generate', {'prompt': 'hi', 'seed': -7}), get, bad_get])
+    assert [head[0] for head, _ in responses] == ['HTTP/1.1 200 OK', 'HTTP/1.1 200 OK', 'HTTP/1.1 400 Bad Request']
+    assert json.loads(responses[0][1]) == json.loads(responses[1][1])
+
+
+def test_stream_is_unchunked_for_http_1_0(trained):
+    request = b'GET /stream?prompt=hi&seed=3 HTTP/1.0\r\nConnection: keep-alive\r\n\r\n'
+    [(head, body)] = run(trained, [request])
+    assert 'Connection: close' in head
+    assert not any(line.lower().startswith('transfer-encoding') for line in head)
+    events = body.decode('utf-8').split('\n\n')
+    assert events[-2:] == ['event: done\ndata: {}', '']
+    text = ''.join(json.loads(event[len('data: '):])['text'] for event in events[:-2])
+    assert text == AggmGPT1_5(ngram_models=trained.ngram_models).AskAggmGPT1_5('hi', 3)
+
+
+def test_stream_is_chunked_for_http_1_1(trained):
+    [(head, body)] = run(trained, [post('/stream', {'prompt': 'hi', 'seed': 3})])
+    assert 'Transfer-Encoding: chunked' in head
+    assert body.endswith(b'\r\n0\r\n\r\n')
+
+
+def test_shutdown_closes_idle_keep_alive_connections(trained):
+    async def main():
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        server = Server(AggmGPT1_5(ngram_models=trained.ngram_models), port=0)
+        await server.start()
+        port = server.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /health HTTP/1.1\r\n\r\n')
+        head = await reader.readuntil(b'\r\n\r\n')
+        assert b'Connection: keep-alive' in head
+        await reader.readexactly(len(json.dumps({'status': 'ok'})))
+        await server.shutdown()
+        assert await asyncio.wait_for(reader.read(), 5) == b''
+        writer.close()
+        await asyncio.sleep(0.1)
+        return errors
+    assert asyncio.run(main()) == []
@@ -0,0 +1,65 @@
+import contextlib
+import io
+
+import pytest
+
+from AggmGPT1_5 import AggmGPT1_5
+from data import corpus
+from ngram import NgramModel
+from pruning import Pruning
+from snapshot import SnapshotError, corpus_digest, read_snapshot
+from training import DOCUMENT_SEPARATOR
+
+DOCUMENTS = ['user: what is in the logs?\nai: Nothing but zorblax.', 'user: and now?\nai: Still zorblax.']
+
+
+def quiet(call, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return call(*args, **kwargs)
+
+
+@pytest.mark.parametrize('train', ['train_documents', 'train_parallel', 'train_files'])
+def test_streamed_models_are_not_saved_as_the_corpus_model(tmp_path, trained, train):
+    model = AggmGPT1_5(ngram_models=trained.ngram_models)
+    if train == 'train_files':
+        source = tmp_path / 'log.txt'
+        source.write_text(DOCUMENTS[0], encoding='utf-8')
+        models, text = quiet(model.train_files, [str(source)]), DOCUMENTS[0] + '\n'
+    else:
+        models, text = quiet(getattr(model, train), DOCUMENTS), DOCUMENT_SEPARATOR.join(DOCUMENTS)
+    assert models.digest == corpus_digest(text)
+    path = str(tmp_path / 'model.aggm')
+    model.ngram_models = models
+    model.save(path)
+    with pytest.raises(SnapshotError):
+        read_snapshot(path, corpus)
+    assert read_snapshot(path, text) == models
+    # the constructor retrains from data.py instead of taking the log model
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        assert AggmGPT1_5(snapshot=path).ngram_models == trained.ngram_models
+    assert 'stale' in output.getvalue()
+
+
+def test_digest_follows_the_model(tmp_path, trained):
+    path = str(tmp_path / 'model.aggm')
+    trained.save(path)
+    assert read_snapshot(path, corpus).digest == trained.ngram_models.digest == corpus_digest(corpus)
+    mapped = AggmGPT1_5.load(path, mapped=True)
+    assert mapped.ngram_models.digest == corpus_digest(corpus)
+    mapped.ngram_models.close()
+    pruning = Pruning(top_k=2)
+    pruned = AggmGPT1_5(ngram_models=trained.ngram_models, pruning=pruning)
+    assert quiet(pruned.train_documents, DOCUMENTS).digest == corpus_digest(DOCUMENT_SEPARATOR.join(DOCUMENTS),
+                                                                              pruning.settings())
+
+
+def test_save_needs_the_corpus_of_an_unknown_model(tmp_path, trained):
+    models = trained.ngram_models
+    model = AggmGPT1_5(ngram_models=NgramModel(models.vocabulary, models.max_order, models.edges, models.successors,
+                                               models.root, models.tail))
+    path = str(tmp_path / 'model.aggm')
+    with pytest.raises(ValueError):
+        model.save(path)
+    model.save(path, corpus)
+    assert read_snapshot(path, corpus) == models
@@ -0,0 +1,127 @@
+import os
+import re
+
+from ngram import NgramCounts, Vocabulary
+
+END_OF_TEXT = '<|endoftext|>'
+PUNCTUATION = re.compile(r'[.,!?]')
+CHUNK_SIZE = 1 << 20
+
+
+def file_chunks(paths, chunk_size=CHUNK_SIZE):
+    # Files are read as if they were joined with whitespace.
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        yield '\n'
+
+
+DOCUMENT_SEPARATOR = f'\n{END_OF_TEXT}\n'
+
+
+def document_chunks(documents, chunk_size=CHUNK_SIZE):
+    # Documents are separated by the end-of-text marker, as in data.py.
+    for i, document in enumerate(documents):
+        if i:
+            yield DOCUMENT_SEPARATOR
+        for start in range(0, len(document), chunk_size):
+            yield document[start:start + chunk_size]
+
+
+def hashed_chunks(chunks, text_hash):
+    # Passes the chunks through, adding each to text_hash, so a model
+    # trained on them can record a digest of the text it saw.
+    for chunk in chunks:
+        text_hash.update(chunk.encode('utf-8'))
+        yield chunk
+
+
+class TokenStream:
+    # train_model's cleaning and tokenize() applied to text that arrives in
+    # chunks.  A word cut by a chunk boundary is held until the next chunk.
+    # Punctuation is removed before words are split and lower() never
+    # creates or removes whitespace, so the words come out exactly as
+    # tokenize(cleaned corpus) would give them.
+    def __init__(self):
+        self.partial = ''
+
+    def feed(self, chunk):
+        text = self.partial + PUNCTUATION.sub('', chunk)
+        words = text.split()
+        self.partial = words.pop() if words and not text[-1].isspace() else ''
+        return [word.lower() for word in words]
+
+    def finish(self):
+        partial, self.partial = self.partial, ''
+        return [partial.lower()] if partial else []
+
+
+def appended_chunks(documents, chunk_size=CHUNK_SIZE):
+    # Documents added to a trained model each end with the end-of-text
+    # marker, the way they would be appended to data.py's corpus.
+    for document in documents:
+        yield '\n'
+        for start in range(0, len(document), chunk_size):
+            yield document[start:start + chunk_size]
+        yield DOCUMENT_SEPARATOR
+
+
+def split_documents(documents, shards):
+    # Contiguous ranges of roughly equal length, at least one document each.
+    total = sum(len(document) for document in documents)
+    ranges = []
+    start = size = 0
+    for i, document in enumerate(documents):
+        size += len(document) + 1
+        if size * shards >= total * (len(ranges) + 1) and len(ranges) < shards - 1:
+            ranges.append(documents[start:i + 1])
+            start = i + 1
+    if start < len(documents) or not ranges:
+        ranges.append(documents[start:])
+    return ranges
+
+
+def count_shard(documents, first, final, min_order, max_order, chunk_size=CHUNK_SIZE):
+    # Runs in a worker process.  Counts the windows that lie wholly inside
+    # the shard, in shard-local token ids, and returns the tokens at its two
+    # edges so the parent can count the windows that cross shard boundaries.
+    vocabulary = Vocabulary()
+    tokens = TokenStream()
+    ids = []
+    chunks = document_chunks(documents, chunk_size)
+    for chunk in chunks if first else _prefixed(DOCUMENT_SEPARATOR, chunks):
+        ids.extend(vocabulary.add(word) for word in tokens.feed(chunk))
+    ids.extend(vocabulary.add(word) for word in tokens.finish())
+    counts = NgramCounts(min_order, max_order)
+    counts.add(ids, final=final)
+    return vocabulary.tokens, counts, ids[:max_order - 1], ids[-max_order:], len(ids), final
+
+
+def _prefixed(prefix, chunks):
+    yield prefix
+    yield from chunks
+
+
+def merge_shards(results, min_order, max_order):
+    # A left fold over the shards in text order: for each shard the windows
+    # crossing into it from the shards before, then its own windows.  The
+    # edge ends up as the tail of the whole text, like NgramCounts.feed's.
+    vocabulary = Vocabulary()
+    merged = NgramCounts(min_order, max_order)
+    edge = []
+    for tokens, counts, head, tail, length, final in results:
+        mapping = [vocabulary.add(token) for token in tokens]
+        head = [mapping[i] for i in head]
+        boundary = NgramCounts(min_order, max_order)
+        boundary.add_boundary(edge, head, final and len(head) == length)
+        merged.merge(boundary)
+        merged.merge(counts, mapping)
+        edge = (edge + [mapping[i] for i in tail])[-max_order:]
+    merged.carry = edge
+    return vocabulary, merged